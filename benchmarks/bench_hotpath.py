@@ -0,0 +1,241 @@
+"""
+End-to-end benchmark of the reply hot path, fully offline.
+
+Starts the mock chat-completions server, points the bot at it, and drives
+either chat_response_stream directly ("stream") or the whole on_message
+dispatch ("dispatch": admission control, memory, images, output
+scheduling) at the requested concurrency, with fake Discord channels that
+record every send.
+
+Reports time to first Discord message, end-to-end latency percentiles,
+Discord REST calls per reply, memory-save cost and event-loop lag. With
+--backends N the bot is pointed at N mock servers through its backend pool;
+combine it with --error-rate to watch retries and ejection. With --burst N
+every turn is N messages --burst-gap seconds apart, to compare answering
+each one against burst coalescing (--burst-window). --prompt-cache-slots
+turns on llama.cpp prompt caching against a mock that charges
+--prefill-ms-per-kib for uncached prompt; add --prewarm --typing-lead 2 to
+have every user "type" before sending and compare time to first message.
+--trace-out writes every dispatched request's stage spans as a Chrome trace
+and prints the mean time per stage.
+
+    python benchmarks/bench_hotpath.py --replies 200 --concurrency 20 --mode dispatch
+    python benchmarks/bench_hotpath.py --backends 3 --error-rate 0.2
+    python benchmarks/bench_hotpath.py --burst 3 --burst-window 1.0
+    python benchmarks/bench_hotpath.py --prompt-cache-slots 4 --prefill-ms-per-kib 20 --typing-lead 2 --prewarm
+"""
+import argparse
+import asyncio
+import collections
+import json
+import socket
+import statistics
+import time
+
+from common import import_bot, percentile
+from fake_discord import FakeChannel, FakeMessage, FakeUser
+from mock_openai_server import add_options, options_from_args, start_server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LoopLagProbe:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def timed(func, samples):
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def fmt_ms(values):
+    if not values:
+        return "n/a"
+    return (
+        f"p50={percentile(values, 50) * 1000:8.1f}ms  p90={percentile(values, 90) * 1000:8.1f}ms  "
+        f"p99={percentile(values, 99) * 1000:8.1f}ms  max={max(values) * 1000:8.1f}ms"
+    )
+
+
+async def run(args):
+    ports = [free_port() for _ in range(args.backends)]
+    overrides = {}
+    if args.prompt_cache_slots:
+        overrides["prompt_cache"] = {"enabled": True, "slots": args.prompt_cache_slots}
+    if args.longterm:
+        overrides["longterm"] = {"enabled": True}
+    if args.prewarm:
+        overrides["prewarm"] = {"enabled": True, "min_interval": 0, "max_concurrent": args.concurrency}
+    bot = import_bot(
+        {"API_ENDPOINTS": ",".join(f"http://127.0.0.1:{port}/v1/chat/completions" for port in ports)},
+        overrides,
+    )
+    servers = []
+    for i, port in enumerate(ports):
+        options = options_from_args(args)
+        options.seed = i
+        servers.append(await start_server(options, port=port))
+
+    bot_user = FakeUser(name="Connor", bot=True)
+    bot.bot._connection.user = bot_user
+
+    async def ignore_commands(message):
+        return None
+
+    # Fake messages can't go through the command parser
+    bot.bot.process_commands = ignore_commands
+    if args.burst_window:
+        bot.bursts.window = args.burst_window
+    if args.trace_out:
+        bot.tracer.enabled = True
+        bot.tracer.slow_seconds = 0.0
+        bot.tracer.slow = collections.deque()
+
+    memory_update_times = []
+    journal_flush_times = []
+    bot.update_memory = timed(bot.update_memory, memory_update_times)
+    journal = getattr(bot.conversation_store, "journal", None)
+    if journal is not None:
+        journal.flush = timed(journal.flush, journal_flush_times)
+    bot.conversation_store.start()
+
+    users = [FakeUser(name=f"user{i}") for i in range(args.users)]
+    user_channels = {}
+    probe = LoopLagProbe()
+    probe.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    ttfm, e2e, sends = [], [], []
+
+    async def one(i):
+        async with semaphore:
+            author = users[i % len(users)]
+            if args.typing_lead:
+                # Prewarming only follows users the bot recently answered in the same channel
+                channel = user_channels.setdefault(author.id, FakeChannel(bot_user, latency=args.discord_latency))
+                await bot.on_typing(channel, author, None)
+                await asyncio.sleep(args.typing_lead)
+            else:
+                channel = FakeChannel(bot_user, latency=args.discord_latency)
+            start = time.perf_counter()
+            if args.mode == "stream":
+                message = FakeMessage(channel, author, "connor ơi giải thích json giúp mình")
+                await bot.chat_response_stream(message, author.display_name, channel)
+            else:
+                turn = []
+                for j in range(args.burst):
+                    if j:
+                        await asyncio.sleep(args.burst_gap)
+                    message = FakeMessage(channel, author, f"{bot_user.mention} giải thích json giúp mình ({j + 1})", mentions=[bot_user])
+                    turn.append(asyncio.create_task(bot.on_message(message)))
+                await asyncio.gather(*turn)
+            end = time.perf_counter()
+            events = channel.sends_since(start)
+            e2e.append(end - start)
+            sends.append(len(events))
+            if events:
+                ttfm.append(events[0][0] - start)
+
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.replies)))
+    wall = time.perf_counter() - wall_start
+
+    await probe.stop()
+    await bot.conversation_store.close()
+    await bot.close_http_session()
+    for runner, _, _ in servers:
+        await runner.cleanup()
+
+    print(f"mode={args.mode} replies={args.replies} concurrency={args.concurrency} "
+          f"tokens={args.tokens} @ {args.tokens_per_second}/s  wall={wall:.2f}s")
+    print(f"time to first message  {fmt_ms(ttfm)}")
+    print(f"end-to-end latency     {fmt_ms(e2e)}")
+    print(f"discord calls/reply    mean={statistics.fmean(sends):.2f}  max={max(sends)}")
+    print(f"backend requests/turn  {sum(server_stats.requests for _, _, server_stats in servers) / args.replies:.2f}")
+    if args.mode == "dispatch":
+        print(f"update_memory          {fmt_ms(memory_update_times)}")
+        if journal is not None:
+            print(f"journal flush          {fmt_ms(journal_flush_times)}  ({len(journal_flush_times)} flushes)")
+    print(f"event-loop lag         {fmt_ms(probe.samples)}")
+    for i, (_, url, server_stats) in enumerate(servers):
+        print(f"backend {i:<14} requests={server_stats.requests} errors={server_stats.errors} "
+              f"disconnects={server_stats.disconnects} stalls={server_stats.stalls} "
+              f"client_aborts={server_stats.client_aborts} max_in_flight={server_stats.max_in_flight}")
+        if server_stats.prompt_bytes:
+            print(f"{'':<22} prewarms={server_stats.prewarms} "
+                  f"prompt cached={server_stats.cached_prompt_bytes / server_stats.prompt_bytes:.0%}")
+    if args.trace_out:
+        traces = list(bot.tracer.slow)
+        stages = collections.defaultdict(float)
+        for trace in traces:
+            for name, seconds in trace.breakdown().items():
+                stages[name] += seconds
+        print(f"stage time per request ({len(traces)} traces)")
+        for name, seconds in sorted(stages.items(), key=lambda item: item[1], reverse=True):
+            print(f"  {name:<20} {seconds / max(1, len(traces)) * 1000:8.1f}ms")
+        with open(args.trace_out, "w", encoding="utf-8") as file:
+            json.dump(bot.Tracer.chrome_trace(traces), file)
+        print(f"chrome trace written to {args.trace_out}")
+    failed = sum(1 for sent in sends if not sent)
+    print(f"replies without output {failed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("stream", "dispatch"), default="dispatch")
+    parser.add_argument("--replies", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--discord-latency", type=float, default=0.03, help="seconds per fake REST call")
+    parser.add_argument("--backends", type=int, default=1, help="mock servers behind the backend pool")
+    parser.add_argument("--burst", type=int, default=1, help="messages per turn (dispatch mode)")
+    parser.add_argument("--burst-gap", type=float, default=0.3, help="seconds between the messages of a turn")
+    parser.add_argument("--burst-window", type=float, default=0.0, help="override burst.window (0 keeps config.json)")
+    parser.add_argument("--prompt-cache-slots", type=int, default=0, help="enable prompt_cache with this many slots")
+    parser.add_argument("--prewarm", action="store_true", help="enable typing prewarm (needs --prompt-cache-slots)")
+    parser.add_argument("--typing-lead", type=float, default=0.0, help="seconds each user types before sending")
+    parser.add_argument("--longterm", action="store_true", help="enable long-term memory (recall and indexing on every reply)")
+    parser.add_argument("--trace-out", help="write the request traces here as Chrome trace JSON (dispatch mode)")
+    add_options(parser)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
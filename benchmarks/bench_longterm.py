@@ -0,0 +1,141 @@
+"""
+Long-term memory: indexing rate, recall latency and recall hits as one
+user's history grows.
+
+For every size an index with that many synthetic exchanges is built for a
+single user (small talk about random topics, with --facts distinctive facts
+planted at random points), then --queries recalls run through the same
+LongTermMemory.recall() the bot awaits per request: the first one after the
+index was reopened (parsing the text file and mapping the vectors) and the
+steady state. Fact queries are reworded questions about a planted fact and
+count as hits when its snippet comes back. The prompt cost of the recalled
+snippets is shown next to what sending every stored exchange would cost.
+
+    python benchmarks/bench_longterm.py --sizes 1000,10000,100000
+    python benchmarks/bench_longterm.py --sizes 10000 --dim 1024 --top-k 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from bench_hotpath import fmt_ms
+from common import import_bot
+
+TOPICS = [
+    "thời tiết", "bóng đá", "game", "phim", "nhạc", "bài tập", "code python", "discord", "ăn trưa",
+    "cà phê", "mèo", "chó", "du lịch", "xe máy", "điện thoại", "anime", "sách", "ngủ", "mưa", "crush",
+]
+FILLER = "ừ thì hôm nay mình thấy khá là ổn nhưng mà cũng hơi chán một chút vì không có gì làm cả".split()
+FACTS = [
+    ("sinh nhật của tôi là ngày {n} tháng {m}", "sinh nhật tôi ngày mấy"),
+    ("con mèo nhà tôi tên là {name}", "mèo nhà tôi tên gì"),
+    ("tôi đang học đại học ở {city}", "tôi học đại học ở đâu"),
+    ("món tôi ghét nhất là {food}", "tôi ghét ăn món gì nhất"),
+    ("mật khẩu wifi nhà tôi là {word}{n}", "mật khẩu wifi nhà tôi là gì"),
+]
+NAMES = ["Mướp", "Bông", "Mochi", "Tôm", "Sushi", "Miu"]
+CITIES = ["Huế", "Đà Lạt", "Cần Thơ", "Hải Phòng", "Vinh"]
+FOODS = ["mướp đắng", "sầu riêng", "tiết canh", "rau mùi", "nước mắm"]
+
+
+def small_talk(rng):
+    topic = rng.choice(TOPICS)
+    user = f"user: nói chuyện về {topic} " + " ".join(rng.choices(FILLER, k=rng.randint(5, 25)))
+    reply = f"{topic} à, " + " ".join(rng.choices(FILLER, k=rng.randint(10, 60)))
+    return user, reply
+
+
+def plant(rng):
+    template, question = rng.choice(FACTS)
+    fact = template.format(
+        n=rng.randint(1, 28), m=rng.randint(1, 12), name=rng.choice(NAMES),
+        city=rng.choice(CITIES), food=rng.choice(FOODS), word=rng.choice(NAMES).lower(),
+    )
+    return f"user: nhớ giùm nhé, {fact}", "Ok, mình nhớ rồi!", fact, question
+
+
+async def run_size(bot, args, size, root):
+    rng = random.Random(size)
+    memory = bot.LongTermMemory(
+        os.path.join(root, str(size)),
+        bot.HashingEmbedder(args.dim),
+        top_k=args.top_k,
+        min_score=args.min_score,
+        snippet_chars=args.snippet_chars,
+        max_snippets=size * 4,
+    )
+    fact_turns = set(rng.sample(range(size), min(args.facts, size)))
+    facts = []
+    all_tokens = 0
+    start = time.perf_counter()
+    for turn in range(size):
+        if turn in fact_turns:
+            user, reply, fact, question = plant(rng)
+            facts.append((fact, question))
+        else:
+            user, reply = small_talk(rng)
+        all_tokens += bot.estimate_tokens(user) + bot.estimate_tokens(reply)
+        await memory.remember("1", user, reply)
+    build = time.perf_counter() - start
+    vector_path, text_path = memory._paths("1")
+    on_disk = os.path.getsize(vector_path) + os.path.getsize(text_path)
+
+    # Reopen, as after a restart or once the user fell out of open_users
+    memory._open.clear()
+    start = time.perf_counter()
+    await memory.recall("1", small_talk(rng)[0])
+    first = time.perf_counter() - start
+
+    latencies, recalled_tokens, hits = [], [], 0
+    for i in range(args.queries):
+        fact = None
+        if facts and i % 2 == 0:
+            fact, query = facts[i // 2 % len(facts)]
+        else:
+            query = small_talk(rng)[0]
+        start = time.perf_counter()
+        snippets = await memory.recall("1", query, skip_turns=args.window)
+        latencies.append(time.perf_counter() - start)
+        recalled_tokens.append(sum(bot.estimate_tokens(snippet) for snippet in snippets))
+        if fact is not None and any(fact in snippet for snippet in snippets):
+            hits += 1
+    snippet_count = len(memory._open["1"].offsets)
+    await memory.close()
+
+    fact_queries = (args.queries + 1) // 2 if facts else 0
+    print(f"{size} exchanges ({snippet_count} snippets, {on_disk / 2 ** 20:.1f} MiB on disk, "
+          f"built at {size / build:,.0f} exchanges/s)")
+    print(f"  first recall after reopen  {first * 1000:8.1f}ms")
+    print(f"  recall                     {fmt_ms(latencies)}")
+    print(f"  planted facts recalled     {hits}/{fact_queries}")
+    print(f"  prompt tokens: recalled {sum(recalled_tokens) / len(recalled_tokens):.0f}/request, "
+          f"whole history {all_tokens:,}")
+
+
+async def run(args):
+    bot = import_bot()
+    if bot.np is None:
+        raise SystemExit("numpy is not installed")
+    root = os.path.join(os.getcwd(), "longterm_bench")
+    for size in (int(value) for value in args.sizes.split(",")):
+        await run_size(bot, args, size, root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated exchanges per user")
+    parser.add_argument("--queries", type=int, default=200, help="recalls measured per size")
+    parser.add_argument("--facts", type=int, default=20, help="distinctive facts planted in the history")
+    parser.add_argument("--window", type=int, default=3, help="newest exchanges skipped as still in the prompt")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--min-score", type=float, default=0.2)
+    parser.add_argument("--snippet-chars", type=int, default=600)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compare chat_memory persistence: the legacy full rewrite through save_file
+against the write-behind MemoryJournal.
+
+Every "save" appends one message to a random user, like update_memory does.
+The on-loop column is how long the event loop is blocked per save.
+
+    python benchmarks/bench_memory_save.py --users 20000 --saves 500
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from common import import_bot, summarize
+
+
+def build_memory(users):
+    memory = {}
+    for i in range(users):
+        memory[str(100000000000000000 + i)] = {
+            "username": f"user{i}",
+            "messages": [
+                {"role": "user" if n % 2 == 0 else "assistant", "content": f"user{i}: " + "xin chào " * 20}
+                for n in range(6)
+            ],
+        }
+    return memory
+
+
+def touch(memory, user_id, n):
+    messages = memory[user_id]["messages"]
+    messages.append({"role": "user", "content": f"message {n}"})
+    if len(messages) > 6:
+        messages.pop(0)
+
+
+def bench_legacy(bot, memory, saves):
+    user_ids = list(memory)
+    stalls = []
+    start = time.perf_counter()
+    for n in range(saves):
+        t0 = time.perf_counter()
+        touch(memory, random.choice(user_ids), n)
+        bot.save_file("legacy_memory.json", memory)
+        stalls.append(time.perf_counter() - t0)
+    return time.perf_counter() - start, stalls
+
+
+async def bench_journal(bot, memory, saves):
+    journal = bot.MemoryJournal("journal_memory.json", "journal_memory.journal")
+    journal.data = memory
+    await journal.compact()
+    journal.start()
+    user_ids = list(memory)
+    stalls = []
+    start = time.perf_counter()
+    for n in range(saves):
+        t0 = time.perf_counter()
+        user_id = random.choice(user_ids)
+        touch(memory, user_id, n)
+        journal.mark_dirty(user_id)
+        stalls.append(time.perf_counter() - t0)
+        # Yield like a real handler would between replies
+        await asyncio.sleep(0)
+    await journal.flush()
+    elapsed = time.perf_counter() - start
+    await journal.close()
+    return elapsed, stalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--saves", type=int, default=200)
+    args = parser.parse_args()
+
+    bot = import_bot()
+    random.seed(0)
+
+    elapsed, stalls = bench_legacy(bot, build_memory(args.users), args.saves)
+    print(f"save_file      {args.saves / elapsed:10.1f} saves/s  on-loop {summarize(stalls)}")
+
+    elapsed, stalls = asyncio.run(bench_journal(bot, build_memory(args.users), args.saves))
+    print(f"MemoryJournal  {args.saves / elapsed:10.1f} saves/s  on-loop {summarize(stalls)}")
+
+
+if __name__ == "__main__":
+    main()
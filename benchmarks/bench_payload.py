@@ -0,0 +1,131 @@
+"""
+Request body construction: the old per-reply rebuild (copy every history
+message, sanitize_messages, json.dumps of the whole payload including image
+data URLs) against PayloadCache + RequestBody.
+
+First checks that both produce the same "messages" for random histories
+(leading assistant turns, repeated roles, empty replies, images), then
+simulates a conversation growing turn by turn and reports CPU time and peak
+allocation per request.
+
+    python benchmarks/bench_payload.py --turns 200 --images 2 --image-kib 1024
+"""
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+from collections import deque
+
+from common import import_bot
+
+
+def legacy_body(bot, system_prompt, history, user_payload, params):
+    messages = []
+    if system_prompt.strip():
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend(msg.to_json() for msg in history)
+    messages.append({"role": "user", "content": user_payload})
+    payload = {**params, "messages": bot.sanitize_messages(messages)}
+    # What aiohttp's json= did with it
+    return json.dumps(payload).encode("utf-8")
+
+
+def new_body(bot, cache, user_id, system_prompt, history, user_payload, params):
+    chunks = cache.messages(user_id, system_prompt, history, {"role": "user", "content": user_payload})
+    return bot.RequestBody(chunks, dict(params)).chunks()
+
+
+def joined(chunks):
+    return b"".join(chunk if isinstance(chunk, bytes) else chunk.encode("ascii") for chunk in chunks)
+
+
+def random_payload(rng, data_url):
+    payload = [{"type": "text", "text": f"An: câu hỏi {rng.randint(0, 99)}"}]
+    if rng.random() < 0.3:
+        payload.append({"type": "image_url", "image_url": {"url": data_url}})
+    return payload
+
+
+def check_equivalence(bot, rounds=300):
+    rng = random.Random(0)
+    data_url = bot._encode_data_url(os.urandom(300), "image/png")
+    for _ in range(rounds):
+        cache = bot.PayloadCache()
+        history = []
+        system_prompt = rng.choice(["", "Bạn là Connor \"vui tính\".", "  "])
+        for _ in range(rng.randint(1, 12)):
+            role = rng.choice(["user", "assistant", "user"])
+            content = rng.choice(["", "xin chào", "line 1\nline 2", "emoji 😄"])
+            history.append(bot.StoredMessage(role, f"An: {content}" if role == "user" else content))
+            window = history[rng.randint(0, max(0, len(history) - 3)):]
+            user_payload = random_payload(rng, data_url)
+            params = {"model": "m", "stream": True}
+            want = json.loads(legacy_body(bot, system_prompt, window, user_payload, params))
+            got = json.loads(joined(new_body(bot, cache, "u", system_prompt, window, user_payload, params)))
+            assert got == want, (window, got, want)
+    print(f"equivalence: {rounds} random conversations ok")
+
+
+def measure(func, repeat):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def simulate(bot, turns, images, image_kib, max_history):
+    rng = random.Random(1)
+    image = bot._encode_data_url(os.urandom(image_kib * 1024), "image/webp")
+    system_prompt = "Bạn là Connor, một bot Discord thân thiện. " * 20
+    params = {"model": "m", "max_tokens": 4096, "stream": True, "user": "1"}
+    history = deque()
+    cache = bot.PayloadCache()
+    legacy_times, new_times, legacy_peaks, new_peaks = [], [], [], []
+    for turn in range(turns):
+        history.append(bot.StoredMessage("user", f"An: tin nhắn số {turn} " + "chữ " * rng.randint(5, 60)))
+        window = list(history)
+        user_payload = [{"type": "text", "text": f"An: tin nhắn số {turn}"}]
+        user_payload += [{"type": "image_url", "image_url": {"url": image}} for _ in range(images)]
+
+        elapsed, peak = measure(lambda: legacy_body(bot, system_prompt, window, user_payload, params), 1)
+        legacy_times.append(elapsed)
+        legacy_peaks.append(peak)
+        elapsed, peak = measure(lambda: new_body(bot, cache, "1", system_prompt, window, user_payload, params), 1)
+        new_times.append(elapsed)
+        new_peaks.append(peak)
+
+        history.append(bot.StoredMessage("assistant", "Connor trả lời " + "nhé " * rng.randint(10, 120)))
+        while len(history) > max_history:
+            history.popleft()
+
+    def avg(values):
+        return sum(values) / len(values)
+
+    print(f"{turns} turns, history <= {max_history} messages, {images} x {image_kib} KiB image(s) per turn")
+    print(f"  rebuild + json.dumps    {avg(legacy_times) * 1e6:9.1f} us/request  peak {avg(legacy_peaks) / 1024:9.1f} KiB")
+    print(f"  PayloadCache chunks     {avg(new_times) * 1e6:9.1f} us/request  peak {avg(new_peaks) / 1024:9.1f} KiB")
+    print(f"  prefix cache hits={cache.hits} misses={cache.misses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--images", type=int, default=1)
+    parser.add_argument("--image-kib", type=int, default=1024)
+    parser.add_argument("--max-history", type=int, default=24)
+    args = parser.parse_args()
+
+    bot = import_bot()
+    check_equivalence(bot)
+    simulate(bot, args.turns, args.images, args.image_kib, args.max_history)
+    simulate(bot, args.turns, 0, 0, args.max_history)
+
+
+if __name__ == "__main__":
+    main()
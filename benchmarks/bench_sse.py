@@ -0,0 +1,205 @@
+"""
+Correctness checks and timings for the streaming reply parser, fed by the
+SSE transcripts in benchmarks/transcripts/.
+
+Every transcript is replayed with several network fragmentations (whole
+lines like the old readline loop saw, random small chunks that split UTF-8
+characters, single bytes) through SSEParser + StreamAssembler, and the
+assembled answer is compared with transcripts/expected.json. Then a long
+answer (--tokens deltas) is timed against the original parse loop.
+
+    python benchmarks/bench_sse.py --tokens 4096
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from common import import_bot
+
+TRANSCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts")
+
+
+def legacy_parse(chunks):
+    """The pre-SSEParser loop from chat_response_stream, with sends collected into a list."""
+    sent = []
+    full_response = ""
+    processed_idx = 0
+    send_idx = 0
+    codeblock_stack = []
+
+    def drain_lines_up_to(limit):
+        nonlocal send_idx
+        while True:
+            idx = full_response.find("\n", send_idx, limit)
+            if idx == -1:
+                break
+            piece = full_response[send_idx: idx + 1]
+            if piece.strip() != "":
+                sent.append(piece.rstrip("\n"))
+            send_idx = idx + 1
+
+    for raw in chunks:
+        chunk = raw.decode("utf-8")
+        for line in chunk.splitlines():
+            line = line.strip()
+            if not line or not line.startswith("data:"):
+                continue
+            json_str = line[len("data:"):].strip()
+            if json_str == "[DONE]":
+                break
+            try:
+                j = json.loads(json_str)
+            except Exception:
+                continue
+            delta_obj = (j.get("choices") or [{}])[0].get("delta", {})
+            if not delta_obj:
+                continue
+            delta = delta_obj.get("content")
+            if not isinstance(delta, str) or not delta:
+                continue
+
+            full_response += delta
+            new_len = len(full_response)
+            search_start = max(0, processed_idx - 2)
+            new_section = full_response[search_start:]
+            offset = search_start
+            find_pos = new_section.find("```")
+            while find_pos != -1:
+                abs_pos = offset + find_pos
+                if abs_pos >= processed_idx:
+                    if not codeblock_stack:
+                        codeblock_stack.append(abs_pos)
+                    else:
+                        start_pos = codeblock_stack.pop()
+                        end_pos = abs_pos + 3
+                        if send_idx < start_pos:
+                            drain_lines_up_to(start_pos)
+                        block = full_response[start_pos:end_pos]
+                        if block.strip() != "":
+                            sent.append(block)
+                        send_idx = end_pos
+                find_pos = new_section.find("```", find_pos + 3)
+
+            processed_idx = new_len
+            if not codeblock_stack:
+                drain_lines_up_to(len(full_response))
+
+    tail = full_response[send_idx:].strip()
+    if tail:
+        sent.append(tail)
+    return sent, full_response.strip()
+
+
+def parse(bot, chunks):
+    parser = bot.SSEParser()
+    assembler = bot.StreamAssembler()
+    sent = []
+    done = False
+    for raw in chunks:
+        for data in parser.feed(raw):
+            if data == "[DONE]":
+                done = True
+                break
+            sent.extend(assembler.feed(bot._delta_text(data)))
+        if done:
+            break
+    if not done:
+        for data in parser.close():
+            if data != "[DONE]":
+                sent.extend(assembler.feed(bot._delta_text(data)))
+    sent.extend(assembler.finish())
+    return sent, assembler.text.strip()
+
+
+def fragment(raw, mode, rng):
+    if mode == "lines":
+        return raw.splitlines(keepends=True)
+    if mode == "bytes":
+        return [raw[i:i + 1] for i in range(len(raw))]
+    chunks = []
+    i = 0
+    while i < len(raw):
+        n = rng.randint(1, 64)
+        chunks.append(raw[i:i + n])
+        i += n
+    return chunks
+
+
+def check_transcripts(bot):
+    with open(os.path.join(TRANSCRIPT_DIR, "expected.json"), "r", encoding="utf-8") as file:
+        expected = json.load(file)
+    rng = random.Random(0)
+    for name, want in expected.items():
+        with open(os.path.join(TRANSCRIPT_DIR, name), "rb") as file:
+            raw = file.read()
+        for mode in ("lines", "random", "bytes"):
+            sent, text = parse(bot, fragment(raw, mode, rng))
+            assert text == want.strip(), f"{name}/{mode}: assembled text differs"
+            assert all("�" not in piece for piece in sent), f"{name}/{mode}: broken UTF-8"
+            assert all(piece.count("```") % 2 == 0 for piece in sent), f"{name}/{mode}: split code fence"
+            try:
+                legacy_text = legacy_parse(fragment(raw, mode, rng))[1]
+                legacy = "ok" if legacy_text == want.strip() else "text lost"
+            except UnicodeDecodeError:
+                legacy = "UnicodeDecodeError"
+            print(f"  {name:28} {mode:7} ok  ({len(sent)} pieces; legacy loop: {legacy})")
+
+
+def long_transcript(tokens):
+    """A tokens-long answer mixing prose and code blocks, as raw SSE bytes."""
+    rng = random.Random(1)
+    words = ["Xin", " chào", " bạn", ",", " mình", " là", " Connor", ".", "\n", " hôm", " nay", " trời", " đẹp"]
+    deltas = []
+    while len(deltas) < tokens:
+        if rng.random() < 0.02:
+            deltas.extend(["\n```", "python\n"] + ["x = 1\n"] * rng.randint(5, 40) + ["```\n"])
+        else:
+            deltas.append(rng.choice(words))
+    events = [
+        "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": d}}]}, ensure_ascii=False) + "\n\n"
+        for d in deltas[:tokens]
+    ]
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode("utf-8")
+
+
+def time_long(bot, tokens, repeat):
+    raw = long_transcript(tokens)
+    line_chunks = fragment(raw, "lines", None)
+    # iter_any() hands over whatever the socket delivered, typically a few KB
+    net_chunks = [raw[i:i + 4096] for i in range(0, len(raw), 4096)]
+
+    assert legacy_parse(line_chunks)[1] == parse(bot, net_chunks)[1]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        legacy_parse(line_chunks)
+    legacy = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(bot, net_chunks)
+    new = (time.perf_counter() - start) / repeat
+
+    decoder = "orjson" if bot.orjson is not None else "json"
+    print(f"{tokens}-token answer ({len(raw) / 1024:.0f} KiB of SSE)")
+    print(f"  legacy loop                {legacy * 1000:8.2f} ms")
+    print(f"  SSEParser+StreamAssembler  {new * 1000:8.2f} ms  ({legacy / new:.1f}x, {decoder})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    bot = import_bot()
+    print("transcripts")
+    check_transcripts(bot)
+    time_long(bot, args.tokens, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Startup time and resident memory of the conversation stores as the number
+of stored users grows.
+
+For every size a chat_memory.json with that many users is generated, then
+each store is started in a fresh process that imports bot.py and answers
+--touch lookups of random users, the way the bot starts and sees its first
+messages. The SQLite database is imported from the same JSON once
+beforehand (the one-time migration, timed separately).
+
+    python benchmarks/bench_startup.py --users 10000,100000,1000000
+
+Generating and loading a million users with the "json" store needs several
+GB of RAM.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_mib() -> float:
+    with open("/proc/self/status", "r", encoding="utf-8") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def write_config(workdir, backend):
+    with open(os.path.join(REPO_ROOT, "config.json"), "r", encoding="utf-8") as file:
+        cfg = json.load(file)
+    cfg.setdefault("store", {})["backend"] = backend
+    cfg.setdefault("metrics", {})["port"] = 0
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as file:
+        json.dump(cfg, file, ensure_ascii=False)
+
+
+def generate(path, users, messages):
+    rng = random.Random(0)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("{")
+        for i in range(users):
+            history = []
+            for turn in range(messages):
+                if turn % 2 == 0:
+                    history.append({"role": "user", "content": f"user{i}: tin nhắn {turn} " + "chữ " * rng.randint(3, 15)})
+                else:
+                    history.append({"role": "assistant", "content": "Connor trả lời " + "nhé " * rng.randint(3, 25)})
+            record = {"username": f"user{i}", "messages": history}
+            file.write(("," if i else "") + json.dumps(str(100000000 + i)) + ":" + json.dumps(record, ensure_ascii=False))
+        file.write("}")
+
+
+def child(workdir, users, touch):
+    """Runs in the measured process: import the bot and look up a few users."""
+    os.chdir(workdir)
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    sys.path.insert(0, REPO_ROOT)
+    baseline = rss_mib()
+    start = time.perf_counter()
+    import bot
+    imported = time.perf_counter() - start
+
+    async def lookups():
+        rng = random.Random(1)
+        first = None
+        for _ in range(touch):
+            await bot.conversation_store.get(str(100000000 + rng.randrange(users)))
+            if first is None:
+                first = time.perf_counter() - start
+        result = {
+            "import": imported,
+            "first_lookup": first,
+            "total": time.perf_counter() - start,
+            "rss": rss_mib(),
+            "rss_growth": rss_mib() - baseline,
+            "resident": bot.conversation_store.resident_bytes(),
+        }
+        await bot.conversation_store.close()
+        return result
+
+    print(json.dumps(asyncio.run(lookups())))
+
+
+def run_child(workdir, users, touch):
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", workdir, "--users", str(users), "--touch", str(touch)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="10000,100000", help="comma-separated store sizes")
+    parser.add_argument("--messages", type=int, default=6, help="stored messages per user")
+    parser.add_argument("--touch", type=int, default=200, help="users looked up after startup")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, int(args.users), args.touch)
+        return
+
+    for users in (int(value) for value in args.users.split(",")):
+        root = tempfile.mkdtemp(prefix="bot-startup-")
+        try:
+            json_dir, sqlite_dir = os.path.join(root, "json"), os.path.join(root, "sqlite")
+            os.mkdir(json_dir)
+            os.mkdir(sqlite_dir)
+            write_config(json_dir, "json")
+            write_config(sqlite_dir, "sqlite")
+            start = time.perf_counter()
+            generate(os.path.join(json_dir, "chat_memory.json"), users, args.messages)
+            size = os.path.getsize(os.path.join(json_dir, "chat_memory.json"))
+            print(f"{users} users x {args.messages} messages: chat_memory.json {size / 2 ** 20:.0f} MiB "
+                  f"(generated in {time.perf_counter() - start:.1f}s)")
+
+            shutil.copy(os.path.join(json_dir, "chat_memory.json"), sqlite_dir)
+            migration = run_child(sqlite_dir, users, 1)
+            print(f"  sqlite one-time import      {migration['total']:8.2f}s")
+
+            for name, workdir in (("json", json_dir), ("sqlite", sqlite_dir)):
+                result = run_child(workdir, users, args.touch)
+                print(f"  {name:<7} startup {result['total']:8.2f}s  (import {result['import']:.2f}s, "
+                      f"first lookup {result['first_lookup']:.2f}s)  RSS {result['rss']:8.1f} MiB  "
+                      f"(+{result['rss_growth']:.1f} MiB)  resident conversations {result['resident'] / 2 ** 20:.1f} MiB")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Microbenchmark of trigger keyword matching: the original one-regex-per-keyword
+loop against the precompiled TriggerMatcher. Results of both are checked to
+agree on every message before timing.
+
+    python benchmarks/bench_triggers.py --keywords 300 --messages 5000
+"""
+import argparse
+import random
+import re
+import string
+import time
+
+from common import import_bot
+
+
+def legacy_trigger_matched(text, triggers):
+    text = text.lower()
+    for kw in triggers:
+        pattern = r"\b" + re.escape(kw.lower()) + r"\b"
+        if re.search(pattern, text):
+            return True
+    return False
+
+
+def random_word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keywords", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--hit-rate", type=float, default=0.05, help="fraction of messages containing a keyword")
+    args = parser.parse_args()
+
+    bot = import_bot()
+    rng = random.Random(0)
+    keywords = [random_word(rng) for _ in range(args.keywords)] + ["connor", "c++", "bot ơi"]
+    messages = []
+    for _ in range(args.messages):
+        words = [random_word(rng) for _ in range(rng.randint(3, 25))]
+        if rng.random() < args.hit_rate:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords).upper())
+        messages.append(" ".join(words))
+
+    for text in messages:
+        assert legacy_trigger_matched(text, keywords) == bot.trigger_matched(text, keywords), text
+
+    start = time.perf_counter()
+    for text in messages:
+        legacy_trigger_matched(text, keywords)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for text in messages:
+        bot.trigger_matched(text, keywords)
+    compiled = time.perf_counter() - start
+
+    per_msg = 1e6 / len(messages)
+    print(f"keywords={len(keywords)} messages={len(messages)}")
+    print(f"legacy loop      {legacy * per_msg:9.2f} us/message")
+    print(f"TriggerMatcher   {compiled * per_msg:9.2f} us/message  ({legacy / compiled:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Shared setup for the benchmark scripts.
+
+bot.py reads config.json and its data files from the working directory at
+import time, so every benchmark runs inside a throwaway directory holding a
+copy of the repo config instead of touching the real chat_memory.json.
+"""
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_bot(env=None, overrides=None):
+    """overrides: config.json sections to update, e.g. {"prompt_cache": {"enabled": True}}."""
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    for name in ("config.json", "games.json", "system_prompt.txt"):
+        src = os.path.join(REPO_ROOT, name)
+        if os.path.exists(src):
+            shutil.copy(src, workdir)
+    if overrides:
+        config_path = os.path.join(workdir, "config.json")
+        with open(config_path, "r", encoding="utf-8") as file:
+            config = json.load(file)
+        for section, values in overrides.items():
+            if isinstance(values, dict):
+                config[section] = {**config.get(section, {}), **values}
+            else:
+                config[section] = values
+        with open(config_path, "w", encoding="utf-8") as file:
+            json.dump(config, file, ensure_ascii=False)
+    os.chdir(workdir)
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.update(env or {})
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import bot
+    return bot
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    if not values:
+        return "n/a"
+    return (
+        f"mean={statistics.fmean(values) * 1000:.3f}ms "
+        f"p50={percentile(values, 50) * 1000:.3f}ms "
+        f"p99={percentile(values, 99) * 1000:.3f}ms "
+        f"max={max(values) * 1000:.3f}ms"
+    )
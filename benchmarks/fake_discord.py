@@ -0,0 +1,114 @@
+"""
+Minimal stand-ins for the discord.py objects the bot's hot path touches.
+
+FakeChannel records every send and edit with its timestamp, so benchmarks
+can measure time to first message and REST calls per reply.
+"""
+import asyncio
+import itertools
+import os
+import time
+
+_ids = itertools.count(1_000_000_000_000_000_000)
+
+
+class FakeUser:
+    def __init__(self, user_id=None, name="user", bot=False):
+        self.id = user_id if user_id is not None else next(_ids)
+        self.name = name
+        self.display_name = name
+        self.global_name = name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+
+    def mentioned_in(self, message) -> bool:
+        return any(user.id == self.id for user in message.mentions)
+
+
+class FakeGuild:
+    def __init__(self, guild_id=None):
+        self.id = guild_id if guild_id is not None else next(_ids)
+
+
+class FakeSentMessage:
+    def __init__(self, channel, author, content):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        self.channel.events.append((time.perf_counter(), "edit", len(content or "")))
+        return self
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, bot_user, latency=0.0, channel_id=None):
+        self.id = channel_id if channel_id is not None else next(_ids)
+        self.bot_user = bot_user
+        self.latency = latency
+        self.events = []
+        self.messages = {}
+
+    def typing(self):
+        return _Typing()
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = FakeSentMessage(self, self.bot_user, content)
+        self.messages[message.id] = message
+        self.events.append((time.perf_counter(), "send", len(content or "")))
+        return message
+
+    async def fetch_message(self, message_id):
+        await asyncio.sleep(self.latency)
+        self.events.append((time.perf_counter(), "fetch", 0))
+        return self.messages[message_id]
+
+    def sends_since(self, start):
+        return [event for event in self.events if event[0] >= start and event[1] in ("send", "edit")]
+
+
+class FakeReference:
+    def __init__(self, message):
+        self.message_id = message.id
+        self.resolved = None
+        self.cached_message = None
+
+
+class FakeAttachment:
+    def __init__(self, size, content_type="image/png", filename="image.png", latency=0.0):
+        self.id = next(_ids)
+        self.size = size
+        self.content_type = content_type
+        self.filename = filename
+        self.latency = latency
+
+    async def read(self):
+        await asyncio.sleep(self.latency)
+        return os.urandom(self.size)
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content, mentions=(), reference=None, attachments=()):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.guild = FakeGuild()
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+        self.role_mentions = []
+        self.reference = reference
+        self.attachments = list(attachments)
+        channel.messages[self.id] = self
@@ -0,0 +1,243 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions endpoint.
+
+Streams a canned answer as SSE with a configurable token rate, network
+fragmentation, time to first byte and error/disconnect/stall injection, so
+the bot's hot path can be measured without any network access or real
+model. Clients hanging up mid-stream are counted as aborts, like a real
+server freeing the slot.
+
+With --prefill-ms-per-kib the mock also charges prompt processing time
+for the part of the prompt not already cached in the request's id_slot,
+llama.cpp style, and answers non-streaming max_tokens 0 requests
+(prewarms) after just that prefill.
+
+    python benchmarks/mock_openai_server.py --port 8089 --tokens-per-second 40
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+ANSWER = (
+    "Chào bạn! Mình là Connor đây 😄\n"
+    "Hôm nay mình sẽ giải thích nhanh cách đọc file JSON trong Python nhé.\n\n"
+    "```python\n"
+    "import json\n\n"
+    "with open(\"config.json\", \"r\", encoding=\"utf-8\") as f:\n"
+    "    data = json.load(f)\n"
+    "```\n\n"
+    "Nhớ dùng `ensure_ascii=False` khi ghi tiếng Việt nha.\n"
+    "Có gì cứ hỏi mình tiếp ạ.\n"
+)
+
+
+def split_tokens(text, rng):
+    tokens = []
+    i = 0
+    while i < len(text):
+        n = rng.randint(1, 4)
+        tokens.append(text[i:i + n])
+        i += n
+    return tokens
+
+
+class MockOptions:
+    def __init__(self, tokens=200, tokens_per_second=50.0, ttfb=0.05, fragment=0.0,
+                 error_rate=0.0, disconnect_rate=0.0, stall_rate=0.0, stall_seconds=600.0, prefill_ms_per_kib=0.0,
+                 seed=0):
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.ttfb = ttfb
+        self.fragment = fragment
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.prefill_ms_per_kib = prefill_ms_per_kib
+        self.seed = seed
+
+
+class MockStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.stalls = 0
+        self.client_aborts = 0
+        self.prewarms = 0
+        self.prompt_bytes = 0
+        self.cached_prompt_bytes = 0
+        self.request_bytes = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.payloads = []
+
+
+def answer_tokens(count, rng):
+    tokens = []
+    while len(tokens) < count:
+        tokens.extend(split_tokens(ANSWER, rng))
+    return tokens[:count]
+
+
+def common_prefix(a: bytes, b: bytes) -> int:
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def create_app(options: MockOptions) -> web.Application:
+    rng = random.Random(options.seed)
+    stats = MockStats()
+    slots = {}  # id_slot -> serialized messages of the last prompt processed there
+
+    async def prefill(payload):
+        """Sleep for the prompt processing a llama.cpp slot would need."""
+        prompt = json.dumps(payload.get("messages", []), ensure_ascii=False).encode("utf-8")
+        cached = 0
+        if payload.get("cache_prompt") and "id_slot" in payload:
+            cached = common_prefix(slots.get(payload["id_slot"], b""), prompt)
+            slots[payload["id_slot"]] = prompt
+        stats.prompt_bytes += len(prompt)
+        stats.cached_prompt_bytes += cached
+        if options.prefill_ms_per_kib:
+            await asyncio.sleep((len(prompt) - cached) / 1024 * options.prefill_ms_per_kib / 1000)
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        stats.requests += 1
+        stats.request_bytes += len(body)
+        payload = json.loads(body)
+        stats.payloads.append({key: value for key, value in payload.items() if key != "messages"})
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        try:
+            await asyncio.sleep(options.ttfb)
+            if rng.random() < options.error_rate:
+                stats.errors += 1
+                return web.json_response({"error": {"message": "injected failure"}}, status=500)
+
+            await prefill(payload)
+            max_tokens = payload.get("max_tokens", options.tokens)
+            if not payload.get("stream"):
+                if max_tokens == 0:
+                    stats.prewarms += 1
+                text = "".join(answer_tokens(min(options.tokens, max_tokens), rng))
+                return web.json_response({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "model": payload.get("model", "mock"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "length"}],
+                })
+            resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await resp.prepare(request)
+            disconnect_at = rng.randint(1, options.tokens) if rng.random() < options.disconnect_rate else None
+            stall_at = rng.randint(0, options.tokens) if rng.random() < options.stall_rate else None
+            interval = 1.0 / options.tokens_per_second if options.tokens_per_second > 0 else 0.0
+            started = time.monotonic()
+            for i, token in enumerate(answer_tokens(min(options.tokens, max_tokens), rng)):
+                if disconnect_at is not None and i == disconnect_at:
+                    stats.disconnects += 1
+                    request.transport.close()
+                    return resp
+                if stall_at is not None and i == stall_at:
+                    stats.stalls += 1
+                    # Keep the connection open but go silent; wake up now and
+                    # then to notice a client that hung up
+                    stall_until = time.monotonic() + options.stall_seconds
+                    while time.monotonic() < stall_until:
+                        await asyncio.sleep(0.05)
+                        if request.transport is None or request.transport.is_closing():
+                            raise ConnectionResetError
+                event = {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "model": payload.get("model", "mock"),
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                data = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+                if options.fragment and rng.random() < options.fragment:
+                    # Split mid-event, often mid-character, across two writes
+                    cut = rng.randint(1, len(data) - 1)
+                    await resp.write(data[:cut])
+                    await asyncio.sleep(0)
+                    await resp.write(data[cut:])
+                else:
+                    await resp.write(data)
+                delay = started + (i + 1) * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await resp.write(b"data: [DONE]\n\n")
+            await resp.write_eof()
+            return resp
+        except ConnectionResetError:
+            stats.client_aborts += 1
+            return web.Response(status=499)
+        finally:
+            stats.in_flight -= 1
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["stats"] = stats
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/health", health)
+    return app
+
+
+async def start_server(options: MockOptions, host="127.0.0.1", port=0):
+    """Start the mock in the running loop. Returns (runner, base_url, stats)."""
+    app = create_app(options)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = runner.addresses[0][1]
+    return runner, f"http://{host}:{bound_port}", app["stats"]
+
+
+def add_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--tokens", type=int, default=200, help="deltas per answer")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--ttfb", type=float, default=0.05, help="seconds before the response starts")
+    parser.add_argument("--fragment", type=float, default=0.0, help="fraction of events split across writes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="fraction of streams cut mid-answer")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of streams that go silent mid-answer")
+    parser.add_argument("--prefill-ms-per-kib", type=float, default=0.0, help="prompt processing cost of uncached prompt bytes")
+
+
+def options_from_args(args) -> MockOptions:
+    return MockOptions(
+        tokens=args.tokens,
+        tokens_per_second=args.tokens_per_second,
+        ttfb=args.ttfb,
+        fragment=args.fragment,
+        error_rate=args.error_rate,
+        disconnect_rate=args.disconnect_rate,
+        stall_rate=args.stall_rate,
+        prefill_ms_per_kib=args.prefill_ms_per_kib,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_options(parser)
+    args = parser.parse_args()
+    web.run_app(create_app(options_from_args(args)), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Replay logged traffic against the bot's dispatch path, fully offline.
+
+Reads request log files written by the bot (logs/requests.jsonl, rotated
+copies and per-shard files can all be passed at once), and re-sends every
+request as a message mentioning the bot, from the same user in the same
+channel, through on_message: admission control, memory, images and output
+scheduling all run as in production, against the mock chat-completions
+server. Arrivals keep their original spacing, divided by --speed (0 sends
+everything at once). Images are replaced by random bytes of the logged size,
+and messages logged without text get a placeholder.
+
+Prints the original and the replayed status counts and latencies side by
+side; the replayed numbers come from the bot's own request log.
+
+    python benchmarks/replay_requests.py logs/requests.jsonl* --speed 10
+    python benchmarks/replay_requests.py requests.jsonl --speed 0 --backends 2 --tokens-per-second 80
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+
+from bench_hotpath import LoopLagProbe, fmt_ms, free_port
+from common import import_bot
+from fake_discord import FakeAttachment, FakeChannel, FakeMessage, FakeUser
+from mock_openai_server import add_options, options_from_args, start_server
+
+
+def load_records(paths, limit=0):
+    records = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "ts" in record and "user_id" in record:
+                    records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+
+def describe(label, records):
+    statuses = collections.Counter(record.get("status", "?") for record in records)
+    ttft = [record["ttft"] for record in records if record.get("ttft") is not None]
+    total = [record["total"] for record in records if record.get("total") is not None]
+    print(f"{label:<9} {len(records)} requests  " + "  ".join(f"{k}={v}" for k, v in sorted(statuses.items())))
+    print(f"  time to first token  {fmt_ms(ttft)}")
+    print(f"  request total        {fmt_ms(total)}")
+
+
+async def run(args):
+    records = load_records(args.logs, args.limit)
+    if not records:
+        raise SystemExit("no request records found")
+
+    ports = [free_port() for _ in range(args.backends)]
+    bot = import_bot({"API_ENDPOINTS": ",".join(f"http://127.0.0.1:{port}/v1/chat/completions" for port in ports)})
+    servers = []
+    for i, port in enumerate(ports):
+        options = options_from_args(args)
+        options.seed = i
+        servers.append(await start_server(options, port=port))
+
+    bot_user = FakeUser(name="Connor", bot=True)
+    bot.bot._connection.user = bot_user
+
+    async def ignore_commands(message):
+        return None
+
+    bot.bot.process_commands = ignore_commands
+    bot.conversation_store.start()
+    bot.request_log.start()
+
+    users, channels = {}, {}
+    probe = LoopLagProbe()
+    probe.start()
+
+    async def one(record):
+        user_id, channel_id = int(record["user_id"]), int(record.get("channel_id") or 0)
+        author = users.setdefault(user_id, FakeUser(user_id=user_id, name=f"user{len(users)}"))
+        channel = channels.setdefault(channel_id, FakeChannel(bot_user, latency=args.discord_latency, channel_id=channel_id))
+        images = record.get("images", 0)
+        attachments = [
+            FakeAttachment(max(1, record.get("image_bytes", 0) * 3 // 4 // images), latency=args.discord_latency)
+            for _ in range(images)
+        ]
+        text = record.get("text") or "tin nhắn"
+        message = FakeMessage(channel, author, f"{bot_user.mention} {text}", mentions=[bot_user], attachments=attachments)
+        await bot.on_message(message)
+
+    tasks = []
+    first_ts = records[0]["ts"]
+    wall_start = time.perf_counter()
+    for record in records:
+        if args.speed > 0:
+            delay = wall_start + (record["ts"] - first_ts) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(record)))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    wall = time.perf_counter() - wall_start
+
+    await probe.stop()
+    await bot.request_log.close()
+    await bot.conversation_store.close()
+    await bot.close_http_session()
+    for runner, _, _ in servers:
+        await runner.cleanup()
+
+    span = records[-1]["ts"] - first_ts
+    print(f"replayed {len(records)} requests from {len(users)} users in {len(channels)} channels: "
+          f"original span {span:.1f}s, speed {args.speed or 'max'}, wall {wall:.2f}s")
+    describe("original", records)
+    describe("replay", load_records([bot.request_log.path]))
+    print(f"event-loop lag         {fmt_ms(probe.samples)}")
+    failures = [result for result in results if isinstance(result, BaseException)]
+    if failures:
+        print(f"dispatch exceptions    {len(failures)} (first: {failures[0]!r})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("logs", nargs="+", help="request log files to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression; 0 sends as fast as possible")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    parser.add_argument("--discord-latency", type=float, default=0.03, help="seconds per fake REST call")
+    parser.add_argument("--backends", type=int, default=1, help="mock servers behind the backend pool")
+    add_options(parser)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,24 @@
+import abc
 import os
 import json
 import random
 import asyncio
 import base64
+import bisect
+import codecs
+import contextvars
+import hashlib
+import importlib
+import io
 import mimetypes
 import re
-from collections import OrderedDict
+import sqlite3
+import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import List
 
 import aiohttp
@@ -14,378 +27,3993 @@ from discord import app_commands
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ----------------------------
+# Load configuration and env
+# ----------------------------
+load_dotenv()
+
+CONFIG_FILE = "config.json"
+STATUS_FILE = "games.json"
+MEMORY_FILE = "chat_memory.json"
+MEMORY_JOURNAL_FILE = "chat_memory.journal"
+
+# Connection pool and timeouts for the shared LLM client (seconds)
+HTTP_DEFAULTS = {
+    "limit": 100,
+    "limit_per_host": 16,
+    "keepalive_timeout": 75,
+    "dns_cache_ttl": 300,
+    "connect_timeout": 10,
+    "first_byte_timeout": 120,
+    "read_timeout": 120,
+}
+
+# Where conversations are stored: "sqlite" (one WAL database shared by every
+# shard process, loaded on demand) or "json" (chat_memory.json + journal, all
+# in RAM, one process only)
+STORE_DEFAULTS = {
+    "backend": "sqlite",
+    "sqlite_path": "chat_memory.sqlite3",
+    "cache_users": 4096,
+    "cache_max_bytes": 64 * 1024 * 1024,
+    "idle_ttl": 3600,
+    "busy_timeout": 10,
+    "import_json": True,
+}
+
+# Write-behind persistence of chat_memory
+MEMORY_DEFAULTS = {
+    "flush_batch_size": 64,
+    "flush_interval": 2.0,
+    "compact_bytes": 8 * 1024 * 1024,
+}
+
+# How streamed replies are turned into Discord messages
+OUTPUT_DEFAULTS = {
+    "mode": "batch",
+    "debounce": 0.5,
+    "max_delay": 1.5,
+    "max_message_chars": 2000,
+    "rate_limit_messages": 5,
+    "rate_limit_per": 5.0,
+}
+
+# Admission control for concurrent LLM requests
+SCHEDULER_DEFAULTS = {
+    "max_in_flight": 8,
+    "max_per_user": 1,
+    "max_per_channel": 4,
+    "max_queue": 64,
+    "max_wait": 120,
+}
+
+# llama.cpp prompt cache reuse: pin each user to a server slot
+PROMPT_CACHE_DEFAULTS = {
+    "enabled": False,
+    "slots": 4,
+}
+
+# Token-budgeted conversation history
+CONTEXT_DEFAULTS = {
+    "max_history_messages": 24,
+    "history_tokens": {"default": 2000},
+    "tokenizer": "auto",
+    "reanchor_fill": 0.6,
+    "summary": False,
+    "summary_max_chars": 800,
+}
+
+# Similarity-searched memory of older turns (needs numpy)
+LONGTERM_DEFAULTS = {
+    "enabled": False,
+    "dir": "longterm_memory",
+    "embedder": "hashing",  # or "module:factory", called with dim, returning an object with embed(texts)
+    "dim": 512,
+    "top_k": 3,             # snippets recalled per request
+    "min_score": 0.2,       # cosine similarity below which a snippet is left out
+    "snippet_chars": 600,   # exchanges longer than this are split into several snippets
+    "max_snippets": 5000,   # per user; the oldest are dropped past this
+    "open_users": 256,      # per-user indexes kept memory-mapped
+}
+
+# Routing across several OpenAI-compatible backends (see "backends")
+BACKEND_POOL_DEFAULTS = {
+    "eject_after": 1,
+    "eject_seconds": 30,
+    "health_interval": 10,
+    "health_timeout": 5,
+    "max_attempts": 2,
+}
+
+# Lifetime of in-flight generations (timeouts in seconds, 0 = none)
+GENERATION_DEFAULTS = {
+    "supersede": True,
+    "cancel_on_delete": True,
+    "first_token_timeout": 120,
+    "idle_timeout": 30,
+}
+
+# Answer a user's rapid-fire messages with one reply
+BURST_DEFAULTS = {
+    "window": 0.0,          # seconds of quiet that close a burst; 0 answers every message on its own
+    "max_window": 6.0,      # a burst never stays open longer than this after its first message
+    "follow_typing": False, # enable the typing intent and keep a burst open while the user types
+}
+
+# Send a user's prompt prefix ahead while they type (llama.cpp prompt cache)
+PREWARM_DEFAULTS = {
+    "enabled": False,       # needs prompt_cache; turns on the typing intent
+    "recent_seconds": 600,  # only for users the bot answered in that channel this recently
+    "min_interval": 30,     # seconds between prewarms of one user
+    "max_concurrent": 2,    # prewarm requests in flight at once
+    "timeout": 15,          # seconds before a prewarm request is abandoned
+}
+
+# Per-stage timing of each answered message
+TRACING_DEFAULTS = {
+    "enabled": True,
+    "slow_seconds": 5.0,  # keep the stage breakdown of requests slower than this
+    "buffer_size": 50,    # slow traces kept for /slowtraces
+}
+
+# One JSON line per LLM request, for debugging and replay
+REQUEST_LOG_DEFAULTS = {
+    "enabled": True,
+    "path": "logs/requests.jsonl",
+    "include_text": False,      # log the user's message text (never image data)
+    "max_bytes": 16 * 1024 * 1024,  # rotate once the file grows past this
+    "backups": 5,               # rotated files kept as path.1 ... path.N
+    "flush_interval": 1.0,      # seconds between batched writes
+    "flush_batch_size": 256,    # write early once this many records wait
+    "max_pending": 10000,       # drop (and count) records beyond this backlog
+}
+
+# Prometheus-style metrics endpoint (port 0 = disabled)
+METRICS_DEFAULTS = {
+    "port": 0,
+    "host": "127.0.0.1",
+    "loop_lag_interval": 0.5,
+}
+
+# Image attachment ingestion (bytes)
+IMAGE_DEFAULTS = {
+    "max_image_bytes": 5 * 1024 * 1024,
+    "max_message_bytes": 16 * 1024 * 1024,
+    "cache_max_bytes": 64 * 1024 * 1024,
+    "cache_dir": "",
+    "cache_dir_max_bytes": 512 * 1024 * 1024,
+    "variant_policy": "original",
+    "variant_max_dimension": 1568,
+    "variant_format": "WEBP",
+    "variant_quality": 85,
+}
+
+
+def load_config():
+    with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+        data = json.load(file)
+
+    data["model_name"] = os.getenv("MODEL_NAME", data.get("model_name", "gpt-4o"))
+    data["api_endpoint"] = os.getenv("API_ENDPOINT", data.get("api_endpoint", "https://api.openai.com/v1/chat/completions"))
+    data["system_prompt"] = os.getenv("SYSTEM_PROMPT", data.get("system_prompt", ""))
+
+    endpoints_env = os.getenv("API_ENDPOINTS")
+    if endpoints_env:
+        data["backends"] = [{"url": url.strip()} for url in endpoints_env.split(",") if url.strip()]
+    else:
+        data["backends"] = list(data.get("backends", []))
+
+    trigger_env = os.getenv("TRIGGER_KEYWORDS")
+    if trigger_env:
+        data["trigger_keywords"] = [kw.strip().lower() for kw in trigger_env.split(",") if kw.strip()]
+    else:
+        data["trigger_keywords"] = [kw.lower() for kw in data.get("trigger_keywords", [])]
+
+    admin_env = os.getenv("ADMIN_IDS")
+    if admin_env:
+        data["admin_ids"] = [int(user_id.strip()) for user_id in admin_env.split(",") if user_id.strip().isdigit()]
+    else:
+        data["admin_ids"] = [int(user_id) for user_id in data.get("admin_ids", []) if str(user_id).isdigit()]
+
+    data["http"] = {**HTTP_DEFAULTS, **data.get("http", {})}
+    data["memory"] = {**MEMORY_DEFAULTS, **data.get("memory", {})}
+    data["store"] = {**STORE_DEFAULTS, **data.get("store", {})}
+    data["output"] = {**OUTPUT_DEFAULTS, **data.get("output", {})}
+    data["scheduler"] = {**SCHEDULER_DEFAULTS, **data.get("scheduler", {})}
+    data["images"] = {**IMAGE_DEFAULTS, **data.get("images", {})}
+    data["prompt_cache"] = {**PROMPT_CACHE_DEFAULTS, **data.get("prompt_cache", {})}
+    data["context"] = {**CONTEXT_DEFAULTS, **data.get("context", {})}
+    data["longterm"] = {**LONGTERM_DEFAULTS, **data.get("longterm", {})}
+    data["metrics"] = {**METRICS_DEFAULTS, **data.get("metrics", {})}
+    data["backend_pool"] = {**BACKEND_POOL_DEFAULTS, **data.get("backend_pool", {})}
+    data["generation"] = {**GENERATION_DEFAULTS, **data.get("generation", {})}
+    data["request_log"] = {**REQUEST_LOG_DEFAULTS, **data.get("request_log", {})}
+    data["tracing"] = {**TRACING_DEFAULTS, **data.get("tracing", {})}
+    data["burst"] = {**BURST_DEFAULTS, **data.get("burst", {})}
+    data["prewarm"] = {**PREWARM_DEFAULTS, **data.get("prewarm", {})}
+    data["recent_message_cache_size"] = int(data.get("recent_message_cache_size", 4096))
+
+    return data
+
+
+def load_file(filename, default_data):
+    try:
+        with open(filename, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        with open(filename, "w", encoding="utf-8") as file:
+            json.dump(default_data, file, indent=4, ensure_ascii=False)
+        return default_data
+
+
+def save_file(filename, data):
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+
+
+class StoredMessage:
+    """One stored chat turn; slots keep millions of them much smaller than dicts."""
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content, tokens=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = tokens  # filled in by ContextBuilder.count
+
+    def to_json(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+def _json_default(value):
+    if isinstance(value, StoredMessage):
+        return value.to_json()
+    if isinstance(value, deque):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _record_from_json(data: dict) -> dict:
+    record = {
+        "username": sys.intern(data.get("username", "")),
+        "messages": deque(StoredMessage(m["role"], m["content"]) for m in data.get("messages", [])),
+    }
+    if data.get("summary"):
+        record["summary"] = data["summary"]
+    return record
+
+
+def atomic_write_json(filename, data):
+    tmp_name = f"{filename}.tmp"
+    with open(tmp_name, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, default=_json_default)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_name, filename)
+
+
+async def wait_until(aw, deadline):
+    """
+    Await aw until the event loop's clock reaches deadline (None waits
+    forever) and raise asyncio.TimeoutError after that. Unlike wait_for
+    before Python 3.12, a cancel that lands just as aw finishes is never
+    swallowed, which matters for tasks that are stopped by cancelling them.
+    """
+    if deadline is None:
+        return await aw
+    task = asyncio.ensure_future(aw)
+    try:
+        done, _ = await asyncio.wait((task,), timeout=max(0.0, deadline - asyncio.get_running_loop().time()))
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        task.cancel()
+        raise asyncio.TimeoutError
+    return task.result()
+
+
+# ----------------------------
+# Memory persistence
+# ----------------------------
+class MemoryJournal:
+    """
+    Write-behind persistence for chat_memory.
+
+    Changed user records are appended to a journal file in batches from a
+    worker thread, and the journal is compacted into the snapshot file in the
+    background. The snapshot is only ever replaced atomically, and replaying
+    the journal over it is idempotent, so a crash at any point loses at most
+    the last unflushed batch.
+    """
+
+    def __init__(self, snapshot_path, journal_path, flush_batch_size=64, flush_interval=2.0,
+                 compact_bytes=8 * 1024 * 1024):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.flush_batch_size = flush_batch_size
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self.data = {}
+        self._dirty = set()
+        self._cleared = False
+        self._journal_bytes = 0
+        self._lock = None
+        self._wakeup = None
+        self._task = None
+
+    def load(self):
+        self.data = load_file(self.snapshot_path, {})
+        valid_bytes = 0
+        try:
+            with open(self.journal_path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    self._apply(entry)
+                    valid_bytes += len(line)
+                torn = file.seek(0, os.SEEK_END) != valid_bytes
+            if torn:
+                # Drop the tail of an append interrupted by a crash so new
+                # entries don't get glued onto a half-written line
+                with open(self.journal_path, "r+b") as file:
+                    file.truncate(valid_bytes)
+        except FileNotFoundError:
+            pass
+        self._journal_bytes = valid_bytes
+        return self.data
+
+    def _apply(self, entry):
+        if entry.get("clear"):
+            self.data.clear()
+        elif entry.get("record") is None:
+            self.data.pop(entry["user_id"], None)
+        else:
+            self.data[entry["user_id"]] = entry["record"]
+
+    def mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.flush_batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def mark_cleared(self):
+        self._dirty.clear()
+        self._cleared = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self.compact()
+
+    async def _run(self):
+        while True:
+            try:
+                # Not wait_for: it can swallow the cancel from close() as the event fires
+                await wait_until(self._wakeup.wait(), asyncio.get_running_loop().time() + self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if self._journal_bytes >= self.compact_bytes:
+                    await self.compact()
+            except OSError as e:
+                print(f"❌ Lỗi ghi bộ nhớ: {e}")
+
+    def _take_batch(self):
+        # Serialize on the loop so the worker thread never sees a record mid-update
+        lines = []
+        if self._cleared:
+            lines.append(json.dumps({"clear": True}) + "\n")
+            self._cleared = False
+        for user_id in self._dirty:
+            entry = {"user_id": user_id, "record": self.data.get(user_id)}
+            lines.append(json.dumps(entry, ensure_ascii=False, default=_json_default) + "\n")
+        self._dirty.clear()
+        return "".join(lines)
+
+    def _append(self, text):
+        with open(self.journal_path, "a", encoding="utf-8") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+            return file.tell()
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._dirty and not self._cleared:
+                return
+            started = time.perf_counter()
+            text = self._take_batch()
+            self._journal_bytes = await asyncio.to_thread(self._append, text)
+            MEMORY_SAVE_SECONDS.observe(time.perf_counter() - started)
+
+    def _write_snapshot(self, snapshot):
+        atomic_write_json(self.snapshot_path, snapshot)
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+
+    async def compact(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Message dicts are never mutated after being appended, so copying
+            # the per-user lists is enough to freeze the current state
+            snapshot = {
+                user_id: {**record, "messages": list(record["messages"])}
+                for user_id, record in self.data.items()
+            }
+            self._cleared = False
+            started = time.perf_counter()
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+            MEMORY_SAVE_SECONDS.observe(time.perf_counter() - started)
+            self._journal_bytes = 0
+
+
+class ConversationStore(abc.ABC):
+    """
+    Where per-user conversation records live.
+
+    A record is {"username", "messages", "summary"?}; "messages" is a deque
+    of StoredMessage, oldest first, capped at
+    context.max_history_messages. Records returned by get() are owned by the
+    store and must be treated as read-only; all changes go through append(),
+    delete() and clear().
+    """
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def resident_bytes(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get(self, user_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def append(self, user_id, username, message: StoredMessage) -> dict:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete(self, user_id) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def clear(self) -> None:
+        raise NotImplementedError
+
+
+def _trim_history(record: dict) -> int:
+    """Drop the oldest messages past max_history_messages, folding them into the summary."""
+    messages = record["messages"]
+    evicted = 0
+    while len(messages) > CONTEXT_CONFIG["max_history_messages"]:
+        message = messages.popleft()
+        evicted += 1
+        if CONTEXT_CONFIG["summary"]:
+            _fold_into_summary(record, message)
+    return evicted
+
+
+def _record_size(record: dict) -> int:
+    """Rough resident size of a record in bytes, for the working set's memory cap."""
+    size = 400 + len(record.get("summary", ""))
+    for message in record["messages"]:
+        content = message.content
+        if isinstance(content, str):
+            size += 120 + len(content)
+        else:
+            size += 120 + sum(200 + len(part.get("text", "")) for part in content)
+    return size
+
+
+class WorkingSet:
+    """
+    The resident part of a conversation store: decoded records in LRU order,
+    bounded by user count and by estimated size, and dropped once idle for
+    idle_ttl seconds. Evicted users are simply loaded again on their next
+    message.
+    """
+
+    def __init__(self, max_users=4096, max_bytes=64 * 1024 * 1024, idle_ttl=3600):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # user_id -> [version, record, size, last_used]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id):
+        """(version, record) for a resident user, or None."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if self.idle_ttl and now - entry[3] > self.idle_ttl:
+            self.pop(user_id)
+            self.evictions += 1
+            return None
+        entry[3] = now
+        self._entries.move_to_end(user_id)
+        return entry[0], entry[1]
+
+    def put(self, user_id, version, record) -> None:
+        self.pop(user_id)
+        size = _record_size(record)
+        self._entries[user_id] = [version, record, size, time.monotonic()]
+        self.bytes += size
+        self._trim()
+
+    def pop(self, user_id) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+    def _trim(self) -> None:
+        expired_before = time.monotonic() - self.idle_ttl if self.idle_ttl else None
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            over = len(self._entries) > self.max_users or (self.max_bytes and self.bytes > self.max_bytes)
+            idle = expired_before is not None and entry[3] < expired_before
+            # Always keep the newest entry, even when it alone is over the cap
+            if not (over or idle) or len(self._entries) == 1:
+                break
+            self.pop(user_id)
+            self.evictions += 1
+
+
+class JsonConversationStore(ConversationStore):
+    """The in-process dict persisted by MemoryJournal; everything stays in RAM."""
+
+    def __init__(self, journal: MemoryJournal):
+        self.journal = journal
+        self.data = journal.load()
+        for user_id, record in self.data.items():
+            self.data[user_id] = _record_from_json(record)
+
+    def start(self):
+        self.journal.start()
+
+    async def close(self):
+        await self.journal.close()
+
+    def count(self) -> int:
+        return len(self.data)
+
+    def resident_bytes(self) -> int:
+        return sum(_record_size(record) for record in self.data.values())
+
+    async def get(self, user_id):
+        return self.data.get(user_id)
+
+    async def append(self, user_id, username, message: StoredMessage) -> dict:
+        record = self.data.get(user_id)
+        if record is None:
+            record = self.data[user_id] = {"username": sys.intern(username), "messages": deque()}
+        record["messages"].append(message)
+        _trim_history(record)
+        self.journal.mark_dirty(user_id)
+        return record
+
+    async def delete(self, user_id) -> bool:
+        if self.data.pop(user_id, None) is None:
+            return False
+        self.journal.mark_dirty(user_id)
+        return True
+
+    async def clear(self) -> None:
+        self.data.clear()
+        self.journal.mark_cleared()
+
+
+class SqliteConversationStore(ConversationStore):
+    """
+    Conversations in one SQLite database in WAL mode, loaded on demand and
+    shared by every shard process.
+
+    Each turn is appended, trimmed and folded into the summary inside a
+    single write transaction, so two processes answering the same user never
+    lose each other's messages. A user's version is the id of their newest
+    message, which is never reused; decoded records stay in a WorkingSet and
+    are only re-read when their version moved, so most lookups are a single
+    indexed row. Opening the store costs the same however many users it
+    holds. All queries run on one worker thread that owns the connection,
+    off the event loop. An existing chat_memory.json (and journal) is
+    imported once, on first use.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            summary TEXT NOT NULL DEFAULT '',
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_user ON messages (user_id, id);
+        CREATE TABLE IF NOT EXISTS store_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path, cache_users=4096, cache_max_bytes=64 * 1024 * 1024, idle_ttl=3600,
+                 busy_timeout=10, import_from=None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.import_from = import_from  # (snapshot path, journal path) of the JSON store
+        self._resident = WorkingSet(cache_users, cache_max_bytes, idle_ttl)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-store")
+        self._db = None
+
+    # Worker thread side
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(self.SCHEMA)
+            if self.import_from is not None:
+                self._import_json(db, *self.import_from)
+            self._db = db
+        return self._db
+
+    def _import_json(self, db, snapshot_path, journal_path):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("SELECT 1 FROM store_meta WHERE key = 'imported_json'").fetchone() is None:
+                data = {}
+                if os.path.exists(snapshot_path) or os.path.exists(journal_path):
+                    data = MemoryJournal(snapshot_path, journal_path).load()
+                for user_id, raw in data.items():
+                    record = _record_from_json(raw)
+                    version = None
+                    for message in record["messages"]:
+                        version = db.execute(
+                            "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                            (user_id, message.role, json.dumps(message.content, ensure_ascii=False)),
+                        ).lastrowid
+                    if version is not None:
+                        db.execute(
+                            "INSERT OR REPLACE INTO conversations (user_id, username, summary, version) VALUES (?, ?, ?, ?)",
+                            (user_id, record["username"], record.get("summary", ""), version),
+                        )
+                db.execute("INSERT INTO store_meta (key, value) VALUES ('imported_json', ?)", (str(len(data)),))
+                if data:
+                    print(f"📦 Đã chuyển {len(data)} cuộc trò chuyện từ {snapshot_path} sang {self.path}")
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _read_record(self, db, user_id, username, summary):
+        rows = db.execute(
+            "SELECT role, content FROM messages WHERE user_id = ? ORDER BY id",
+            (user_id,),
+        ).fetchall()
+        record = {
+            "username": sys.intern(username),
+            "messages": deque(StoredMessage(role, json_loads(content)) for role, content in rows),
+        }
+        if summary:
+            record["summary"] = summary
+        return record
+
+    def _load(self, user_id, cached_version):
+        db = self._connect()
+        row = db.execute(
+            "SELECT username, summary, version FROM conversations WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+        if row is None:
+            return None, None
+        username, summary, version = row
+        if version == cached_version:
+            return version, None
+        return version, self._read_record(db, user_id, username, summary)
+
+    def _append(self, user_id, username, message, cached_version):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT username, summary, version FROM conversations WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+            username, summary, old_version = row if row is not None else (username, "", None)
+            version = db.execute(
+                "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                (user_id, message.role, json.dumps(message.content, ensure_ascii=False)),
+            ).lastrowid
+            evicted = db.execute(
+                "SELECT id, role, content FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT -1 OFFSET ?",
+                (user_id, CONTEXT_CONFIG["max_history_messages"]),
+            ).fetchall()
+            if evicted:
+                if CONTEXT_CONFIG["summary"]:
+                    folded = {"summary": summary}
+                    for _, role, content in reversed(evicted):
+                        _fold_into_summary(folded, StoredMessage(role, json_loads(content)))
+                    summary = folded["summary"]
+                db.execute("DELETE FROM messages WHERE user_id = ? AND id <= ?", (user_id, evicted[0][0]))
+            db.execute(
+                "INSERT INTO conversations (user_id, username, summary, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary, version = excluded.version",
+                (user_id, username, summary, version),
+            )
+            # Nobody else wrote since our cached copy: the caller can patch it in place
+            record = None if old_version == cached_version else self._read_record(db, user_id, username, summary)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return version, len(evicted), username, summary, record
+
+    def _delete(self, user_id):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            existed = db.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,)).rowcount > 0
+            db.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return existed
+
+    def _clear(self):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM conversations")
+            db.execute("DELETE FROM messages")
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _close_db(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # Event loop side
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def close(self):
+        await self._call(self._close_db)
+        self._executor.shutdown(wait=True)
+
+    def count(self) -> int:
+        # Resident users only; counting the table would mean a query per scrape
+        return len(self._resident)
+
+    def resident_bytes(self) -> int:
+        return self._resident.bytes
+
+    def _still_resident(self, user_id, cached) -> bool:
+        current = self._resident.get(user_id)
+        return current is not None and current[0] == cached[0] and current[1] is cached[1]
+
+    async def get(self, user_id):
+        cached = self._resident.get(user_id)
+        version, record = await self._call(self._load, user_id, cached[0] if cached is not None else None)
+        if version is None:
+            self._resident.pop(user_id)
+            return None
+        if record is None:
+            record = cached[1]
+        self._resident.put(user_id, version, record)
+        return record
+
+    async def append(self, user_id, username, message: StoredMessage) -> dict:
+        cached = self._resident.get(user_id)
+        started = time.perf_counter()
+        version, evicted, username, summary, record = await self._call(
+            self._append, user_id, username, message, cached[0] if cached is not None else None
+        )
+        MEMORY_SAVE_SECONDS.observe(time.perf_counter() - started)
+        if record is None:
+            if cached is None:
+                record = {"username": sys.intern(username), "messages": deque()}
+            elif self._still_resident(user_id, cached):
+                record = cached[1]
+            else:
+                # Our cached copy changed hands while the write was in flight
+                return await self.get(user_id)
+            record["messages"].append(message)
+            for _ in range(min(evicted, len(record["messages"]))):
+                record["messages"].popleft()
+            if summary:
+                record["summary"] = summary
+        self._resident.put(user_id, version, record)
+        return record
+
+    async def delete(self, user_id) -> bool:
+        self._resident.pop(user_id)
+        started = time.perf_counter()
+        deleted = await self._call(self._delete, user_id)
+        MEMORY_SAVE_SECONDS.observe(time.perf_counter() - started)
+        return deleted
+
+    async def clear(self) -> None:
+        self._resident.clear()
+        started = time.perf_counter()
+        await self._call(self._clear)
+        MEMORY_SAVE_SECONDS.observe(time.perf_counter() - started)
+
+
+def open_conversation_store(settings: dict) -> ConversationStore:
+    if settings["backend"] == "sqlite":
+        return SqliteConversationStore(
+            settings["sqlite_path"],
+            cache_users=settings["cache_users"],
+            cache_max_bytes=settings["cache_max_bytes"],
+            idle_ttl=settings["idle_ttl"],
+            busy_timeout=settings["busy_timeout"],
+            import_from=(MEMORY_FILE, MEMORY_JOURNAL_FILE) if settings["import_json"] else None,
+        )
+    if settings["backend"] != "json":
+        raise RuntimeError(f"Unknown store backend: {settings['backend']!r}")
+    return JsonConversationStore(MemoryJournal(MEMORY_FILE, MEMORY_JOURNAL_FILE, **config["memory"]))
+
+
+class TriggerMatcher:
+    """
+    All trigger keywords compiled into one alternation regex.
+
+    `\b(?:kw1|kw2|...)\b` matches exactly when one of the per-keyword
+    `\bkw\b` patterns would, so the text is scanned once no matter how many
+    keywords there are. The regex is rebuilt only when the keyword list changes.
+    """
+
+    def __init__(self):
+        self._keywords = None
+        self._pattern = None
+
+    def _compile(self, triggers):
+        self._keywords = list(triggers)
+        if not self._keywords:
+            self._pattern = None
+            return
+        # Longest first so the reported keyword is the most specific one
+        alternatives = sorted({kw.lower() for kw in self._keywords}, key=len, reverse=True)
+        self._pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, alternatives)) + r")\b")
+
+    def match(self, text: str, triggers: list[str]):
+        if triggers != self._keywords:
+            self._compile(triggers)
+        if self._pattern is None:
+            return None
+        found = self._pattern.search(text.lower())
+        return found.group(0) if found else None
+
+
+_trigger_matcher = TriggerMatcher()
+
+
+def match_trigger(text: str, triggers: list[str]):
+    """Return the trigger keyword found in text, or None."""
+    return _trigger_matcher.match(text, triggers)
+
+
+def trigger_matched(text: str, triggers: list[str]) -> bool:
+    return match_trigger(text, triggers) is not None
+
+config = load_config()
+games = load_file(STATUS_FILE, [{"title": "Minecraft"}, {"title": "Half-Life 2"}])
+conversation_store = open_conversation_store(config["store"])
+
+# ----------------------------
+# Bot setup
+# ----------------------------
+intents = discord.Intents.default()
+intents.typing = (
+    (config["burst"]["follow_typing"] and config["burst"]["window"] > 0)
+    or (config["prewarm"]["enabled"] and config["prompt_cache"]["enabled"])
+)
+intents.presences = True
+intents.messages = True
+intents.message_content = True
+
+
+# Set by launcher.py when this process runs some of the bot's shards
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0") or 0)
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip().isdigit()]
+
+
+class ChatBot(commands.AutoShardedBot if SHARD_COUNT else commands.Bot):
+    metrics_runner = None
+
+    async def setup_hook(self):
+        get_http_session()
+        conversation_store.start()
+        backend_pool.start()
+        request_log.start()
+        self.metrics_runner = await start_metrics_server()
+
+    async def close(self):
+        await close_http_session()
+        await conversation_store.close()
+        await backend_pool.close()
+        await request_log.close()
+        if long_term_memory is not None:
+            await long_term_memory.close()
+        await stop_metrics_server(self.metrics_runner)
+        await super().close()
+
+
+shard_options = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS or None} if SHARD_COUNT else {}
+bot = ChatBot(command_prefix="/", intents=intents, **shard_options)
+
+ADMIN_USER_IDS = config["admin_ids"]
+OPENAI_API_URL = config["api_endpoint"]
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+MODEL_NAME = config["model_name"]
+TRIGGER_KEYWORDS = config["trigger_keywords"]
+SYSTEM_PROMPT = ""
+
+if os.path.exists("system_prompt.txt"):
+    try:
+        with open("system_prompt.txt", "r", encoding="utf-8") as f:
+            SYSTEM_PROMPT = f.read()
+    except:
+        SYSTEM_PROMPT = ""
+else:
+    SYSTEM_PROMPT = config.get("system_prompt", "")
+
+HTTP_CONFIG = config["http"]
+OUTPUT_CONFIG = config["output"]
+SCHEDULER_CONFIG = config["scheduler"]
+IMAGE_CONFIG = config["images"]
+PROMPT_CACHE_CONFIG = config["prompt_cache"]
+CONTEXT_CONFIG = config["context"]
+LONGTERM_CONFIG = config["longterm"]
+METRICS_CONFIG = config["metrics"]
+GENERATION_CONFIG = config["generation"]
+REQUEST_LOG_CONFIG = config["request_log"]
+BURST_CONFIG = config["burst"]
+PREWARM_CONFIG = config["prewarm"]
+TRACING_CONFIG = config["tracing"]
+
+# ----------------------------
+# Metrics
+# ----------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, registry, name, help_text, fn=None):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.values = {}
+
+    def _samples(self):
+        if self.fn is not None:
+            value = self.fn()
+            if isinstance(value, dict):
+                # Labelled samples read at scrape time, keyed like self.values
+                return [(self.name, _format_labels(key), sample) for key, sample in value.items()]
+            return [(self.name, "", value)]
+        return [(self.name, _format_labels(key), value) for key, value in self.values.items()]
+
+
+def _format_labels(key) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in key) + "}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        if not self.registry.enabled:
+            return
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append((f"{self.name}_bucket", f'{{le="{bound}"}}', cumulative))
+        samples.append((f"{self.name}_bucket", '{le="+Inf"}', self.count))
+        samples.append((f"{self.name}_sum", "", self.sum))
+        samples.append((f"{self.name}_count", "", self.count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process metrics in the Prometheus text format.
+
+    When the endpoint is disabled every update returns right away, so the
+    instrumentation left in the hot paths costs a method call and nothing more.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, fn=None) -> Counter:
+        return self._add(Counter(self, name, help_text, fn))
+
+    def gauge(self, name, help_text, fn=None) -> Gauge:
+        return self._add(Gauge(self, name, help_text, fn))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, name, help_text, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric._samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(enabled=METRICS_CONFIG["port"] > 0)
+
+LLM_TTFT_SECONDS = metrics.histogram("llm_time_to_first_token_seconds", "Time from sending a request to its first streamed token")
+LLM_GENERATION_SECONDS = metrics.histogram("llm_generation_seconds", "Total time of a streamed generation")
+LLM_TOKENS_PER_SECOND = metrics.histogram("llm_tokens_per_second", "Streamed deltas per second after the first token", RATE_BUCKETS)
+DISCORD_SEND_SECONDS = metrics.histogram("discord_send_seconds", "Latency of channel.send and message.edit calls")
+QUEUE_WAIT_SECONDS = metrics.histogram("llm_queue_wait_seconds", "Time a generation waited for a scheduler slot")
+MEMORY_SAVE_SECONDS = metrics.histogram("memory_save_seconds", "Duration of chat memory writes: journal flushes and compactions, or SQLite transactions")
+IMAGE_FETCH_SECONDS = metrics.histogram("image_fetch_seconds", "Time to download an image attachment")
+IMAGE_ENCODE_SECONDS = metrics.histogram("image_encode_seconds", "Time to hash, downscale and encode an image")
+TRIGGER_MATCHES = metrics.counter("trigger_matches_total", "Messages that matched a trigger keyword")
+MENTIONS = metrics.counter("mentions_total", "Messages that mentioned the bot")
+REPLIES = metrics.counter("replies_total", "Completed LLM replies")
+API_ERRORS = metrics.counter("llm_api_errors_total", "Failed LLM requests")
+BACKEND_RETRIES = metrics.counter("llm_backend_retries_total", "Requests retried on another backend before the first token")
+BURST_MESSAGES_MERGED = metrics.counter("burst_messages_merged_total", "Messages answered as part of an earlier message's burst")
+PREWARMS = metrics.counter("prewarm_requests_total", "Prompt-only requests sent while a user was typing")
+GENERATIONS_CANCELLED = metrics.counter("generations_cancelled_total", "Generations aborted before finishing")
+EVENT_LOOP_LAG_SECONDS = metrics.gauge("event_loop_lag_seconds", "How late the event loop woke up a periodic probe")
+REQUEST_LOG_DROPPED = metrics.counter("request_log_dropped_total", "Request log records dropped because the writer fell behind")
+
+
+# Held here: the event loop only keeps weak references to running tasks
+_loop_lag_task = None
+
+
+async def _measure_loop_lag(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.set(max(0.0, loop.time() - start - interval))
+
+
+async def start_metrics_server():
+    """Serve /metrics on the configured local port; returns the runner, or None when disabled."""
+    global _loop_lag_task
+    if not metrics.enabled:
+        return None
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_CONFIG["host"], METRICS_CONFIG["port"]).start()
+    _loop_lag_task = asyncio.create_task(_measure_loop_lag(METRICS_CONFIG["loop_lag_interval"]))
+    print(f"📈 Metrics: http://{METRICS_CONFIG['host']}:{METRICS_CONFIG['port']}/metrics")
+    return runner
+
+
+async def stop_metrics_server(runner) -> None:
+    global _loop_lag_task
+    if _loop_lag_task is not None:
+        _loop_lag_task.cancel()
+        _loop_lag_task = None
+    if runner is not None:
+        await runner.cleanup()
+
+# ----------------------------
+# Request log
+# ----------------------------
+class RequestLog:
+    """
+    One JSON line per LLM request, for offline analysis and traffic replay
+    (benchmarks/replay_requests.py).
+
+    write() only queues the record; a background task hands batches to a
+    worker thread every flush_interval seconds or once flush_batch_size
+    records are waiting, so logging never blocks a reply on disk I/O. The
+    file is rotated to path.1 ... path.<backups> once it grows past
+    max_bytes. If the writer falls max_pending records behind, new records
+    are dropped and counted instead of piling up in memory.
+    """
+
+    def __init__(self, path, enabled=True, max_bytes=16 * 1024 * 1024, backups=5, flush_interval=1.0,
+                 flush_batch_size=256, max_pending=10000):
+        self.path = path
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.max_pending = max_pending
+        self._pending = []
+        self._size = None
+        self._lock = None
+        self._wakeup = None
+        self._task = None
+
+    def write(self, record: dict) -> None:
+        if not self.enabled:
+            return
+        if len(self._pending) >= self.max_pending:
+            REQUEST_LOG_DROPPED.inc()
+            return
+        self._pending.append(record)
+        if len(self._pending) >= self.flush_batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                # Not wait_for: it can swallow a cancel that lands as the event fires
+                await wait_until(self._wakeup.wait(), asyncio.get_running_loop().time() + self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Shielded so close() cancelling us can't abandon a batch mid-write
+                await asyncio.shield(self.flush())
+            except OSError as e:
+                print(f"❌ Lỗi ghi request log: {e}")
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._size = 0
+
+    def _append(self, data: bytes):
+        if self._size is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as file:
+            file.write(data)
+        self._size += len(data)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            records, self._pending = self._pending, []
+            data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+            await asyncio.to_thread(self._append, data)
+
+
+def _request_log_path(path: str) -> str:
+    # Shard processes each keep their own file; the replay tool merges them
+    if not SHARD_IDS:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{SHARD_IDS[0]}{ext}"
+
+
+request_log = RequestLog(
+    _request_log_path(REQUEST_LOG_CONFIG["path"]),
+    enabled=REQUEST_LOG_CONFIG["enabled"],
+    max_bytes=REQUEST_LOG_CONFIG["max_bytes"],
+    backups=REQUEST_LOG_CONFIG["backups"],
+    flush_interval=REQUEST_LOG_CONFIG["flush_interval"],
+    flush_batch_size=REQUEST_LOG_CONFIG["flush_batch_size"],
+    max_pending=REQUEST_LOG_CONFIG["max_pending"],
+)
+
+
+def _request_entry(message) -> dict:
+    """The fields every request log record starts with."""
+    # When the message was posted, so replays keep the arrival pattern rather than our queueing
+    created_at = getattr(message, "created_at", None)
+    return {
+        "ts": round(created_at.timestamp() if created_at is not None else time.time(), 3),
+        "user_id": str(message.author.id),
+        "channel_id": str(message.channel.id),
+        "message_id": str(message.id),
+    }
+
+
+# ----------------------------
+# Tracing
+# ----------------------------
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Timed stages of one handled message; spans from every task it spawned land here."""
+
+    __slots__ = ("name", "attrs", "wall_start", "started", "finished", "spans", "_lanes")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.wall_start = time.time()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spans = []  # (name, start, end, lane, args)
+        self._lanes = {}
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def add(self, name: str, start: float, end: float, args=None) -> None:
+        task = asyncio.current_task()
+        lane = self._lanes.setdefault(id(task), len(self._lanes))
+        self.spans.append((name, start - self.started, end - self.started, lane, args))
+
+    def breakdown(self) -> dict:
+        """Total seconds per stage name, in order of first appearance."""
+        totals = {}
+        for name, start, end, _, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + end - start
+        return totals
+
+
+class _Span:
+    __slots__ = ("trace", "name", "args", "started")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.started, time.perf_counter(), self.args)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **args):
+    """Time a stage of the current trace; free when nothing is being traced."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, args or None)
+
+
+def add_span(name: str, start: float, end: float = None, **args) -> None:
+    """Record a stage whose start was taken earlier with time.perf_counter()."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, end if end is not None else time.perf_counter(), args or None)
+
+
+class Tracer:
+    """
+    Per-message traces kept only when slow.
+
+    begin() makes a trace current for the handler and every task it starts,
+    so stages timed with span() anywhere down the reply path (reference
+    fetch, images, queueing, memory, backend, Discord sends) are collected
+    without passing anything around. Traces that took at least slow_seconds
+    go into a ring buffer of buffer_size for /slowtraces and Chrome trace
+    export; the rest are dropped.
+    """
+
+    def __init__(self, enabled=True, slow_seconds=5.0, buffer_size=50):
+        self.enabled = enabled
+        self.slow_seconds = slow_seconds
+        self.slow = deque(maxlen=buffer_size)
+        self.finished = 0
+
+    def begin(self, name: str, **attrs):
+        """Start a trace; returns a token for end(), or None when tracing is off."""
+        if not self.enabled:
+            return None
+        trace = Trace(name, attrs)
+        return trace, _current_trace.set(trace)
+
+    def end(self, token) -> None:
+        if token is None:
+            return
+        trace, reset_token = token
+        _current_trace.reset(reset_token)
+        trace.finished = time.perf_counter()
+        self.finished += 1
+        if trace.duration >= self.slow_seconds:
+            self.slow.append(trace)
+
+    @staticmethod
+    def chrome_trace(traces) -> dict:
+        """Traces in Chrome trace-event format (chrome://tracing, Perfetto), one process per trace."""
+        events = []
+        for pid, trace in enumerate(traces, 1):
+            label = " ".join(f"{key}={value}" for key, value in trace.attrs.items())
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{trace.name} {label}"}})
+            base = trace.wall_start * 1e6
+            events.append({"name": trace.name, "ph": "X", "pid": pid, "tid": 0, "ts": base,
+                           "dur": trace.duration * 1e6, "args": trace.attrs})
+            for name, start, end, lane, args in trace.spans:
+                events.append({"name": name, "ph": "X", "pid": pid, "tid": lane + 1, "ts": base + start * 1e6,
+                               "dur": (end - start) * 1e6, "args": args or {}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+tracer = Tracer(
+    enabled=TRACING_CONFIG["enabled"],
+    slow_seconds=TRACING_CONFIG["slow_seconds"],
+    buffer_size=TRACING_CONFIG["buffer_size"],
+)
+
+
+# ----------------------------
+# Shared HTTP client
+# ----------------------------
+# One pooled session for every LLM request so replies reuse keep-alive
+# connections instead of paying a TCP+TLS handshake each time.
+HTTP_SESSION = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONFIG["limit"],
+            limit_per_host=HTTP_CONFIG["limit_per_host"],
+            keepalive_timeout=HTTP_CONFIG["keepalive_timeout"],
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_CONFIG["dns_cache_ttl"],
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=HTTP_CONFIG["connect_timeout"],
+            sock_read=HTTP_CONFIG["read_timeout"],
+        )
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return HTTP_SESSION
+
+
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+
+MAX_IMAGE_BYTES = IMAGE_CONFIG["max_image_bytes"]  # safety limit per image
+MAX_MESSAGE_IMAGE_BYTES = IMAGE_CONFIG["max_message_bytes"]  # budget for all images of one message
+
+
+# ----------------------------
+# Image cache
+# ----------------------------
+class ImageCache:
+    """
+    Cache of encoded image data URLs, bounded by total size rather than count.
+
+    Entries are stored by content hash and looked up by attachment ID, so a
+    refreshed CDN URL or the same picture posted twice still hits. An optional
+    directory keeps a second, larger tier that survives restarts. Depending on
+    variant_policy, images are stored as sent ("original"), replaced by a
+    downscaled and recompressed copy ("downscaled"), or kept on disk next to
+    that copy ("alongside"); the downscaled copy is what gets sent.
+    """
+
+    def __init__(self, max_bytes, cache_dir="", dir_max_bytes=0, variant_policy="original",
+                 max_dimension=1568, variant_format="WEBP", quality=85, max_ids=4096):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.dir_max_bytes = dir_max_bytes
+        self.variant_policy = variant_policy
+        self.max_dimension = max_dimension
+        self.variant_format = variant_format.upper()
+        self.quality = quality
+        self.max_ids = max_ids
+        self.resident_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._ids = OrderedDict()
+        self._dir_bytes = 0
+
+        if variant_policy != "original" and Image is None:
+            print("⚠️ Pillow chưa được cài, ảnh sẽ được gửi nguyên bản (variant_policy bị bỏ qua).")
+            self.variant_policy = "original"
+        if cache_dir:
+            os.makedirs(os.path.join(cache_dir, "ids"), exist_ok=True)
+            self._dir_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "resident_bytes": self.resident_bytes,
+            "disk_bytes": self._dir_bytes,
+        }
+
+    def _remember(self, key: str, data_url: str) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.resident_bytes -= len(old)
+        self._entries[key] = data_url
+        self.resident_bytes += len(data_url)
+        while self.resident_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.resident_bytes -= len(evicted)
+
+    def _link(self, attachment_id, key: str) -> None:
+        self._ids[attachment_id] = key
+        self._ids.move_to_end(attachment_id)
+        if len(self._ids) > self.max_ids:
+            self._ids.popitem(last=False)
+
+    def _lookup(self, key: str):
+        data_url = self._entries.get(key)
+        if data_url is not None:
+            self._entries.move_to_end(key)
+        return data_url
+
+    async def get(self, attachment_id):
+        key = self._ids.get(attachment_id)
+        data_url = self._lookup(key) if key is not None else None
+        if data_url is None and self.cache_dir:
+            key, data_url = await asyncio.to_thread(self._disk_get, attachment_id)
+            if data_url is not None:
+                self.disk_hits += 1
+                self._remember(key, data_url)
+        if data_url is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._link(attachment_id, key)
+        return data_url
+
+    async def add(self, attachment_id, image_bytes: bytes, mime_type: str) -> str:
+        content_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        send_key = content_hash if self.variant_policy == "original" else f"{content_hash}-v"
+        data_url = self._lookup(send_key)
+        if data_url is None:
+            data_url, written = await asyncio.to_thread(self._encode, content_hash, send_key, image_bytes, mime_type)
+            self._dir_bytes += written
+            self._remember(send_key, data_url)
+        self._link(attachment_id, send_key)
+        if self.cache_dir:
+            await asyncio.to_thread(self._disk_link, attachment_id, send_key)
+            if self._dir_bytes > self.dir_max_bytes:
+                self._dir_bytes = await asyncio.to_thread(self._disk_trim)
+        return data_url
+
+    # The methods below run in a worker thread
+    def _encode(self, content_hash, send_key, image_bytes, mime_type):
+        written = 0
+        if self.variant_policy == "alongside" and self.cache_dir:
+            written += self._disk_put(content_hash, _encode_data_url(image_bytes, mime_type))
+        if self.variant_policy != "original":
+            image_bytes, mime_type = self._downscale(image_bytes, mime_type)
+        data_url = _encode_data_url(image_bytes, mime_type)
+        if self.cache_dir:
+            written += self._disk_put(send_key, data_url)
+        return data_url, written
+
+    def _downscale(self, image_bytes, mime_type):
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image.thumbnail((self.max_dimension, self.max_dimension))
+                if self.variant_format == "JPEG" and image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                out = io.BytesIO()
+                image.save(out, format=self.variant_format, quality=self.quality)
+        except (OSError, ValueError) as e:
+            print(f"❌ Lỗi thu nhỏ ảnh: {e}")
+            return image_bytes, mime_type
+        if out.tell() >= len(image_bytes):
+            return image_bytes, mime_type
+        return out.getvalue(), f"image/{self.variant_format.lower()}"
+
+    def _disk_put(self, key, data_url) -> int:
+        path = os.path.join(self.cache_dir, f"{key}.b64")
+        if os.path.exists(path):
+            return 0
+        with open(f"{path}.tmp", "w", encoding="ascii") as file:
+            file.write(data_url)
+        os.replace(f"{path}.tmp", path)
+        return len(data_url)
+
+    def _disk_link(self, attachment_id, key) -> None:
+        with open(os.path.join(self.cache_dir, "ids", str(attachment_id)), "w", encoding="ascii") as file:
+            file.write(key)
+
+    def _disk_get(self, attachment_id):
+        try:
+            with open(os.path.join(self.cache_dir, "ids", str(attachment_id)), "r", encoding="ascii") as file:
+                key = file.read().strip()
+            path = os.path.join(self.cache_dir, f"{key}.b64")
+            with open(path, "r", encoding="ascii") as file:
+                data_url = file.read()
+            os.utime(path)
+            return key, data_url
+        except OSError:
+            return None, None
+
+    def _disk_trim(self) -> int:
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        target = self.dir_max_bytes * 0.9
+        for entry in entries:
+            if total <= target:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+        # Drop the ID links of the images just evicted; reading an image doesn't touch its link
+        for entry in os.scandir(os.path.join(self.cache_dir, "ids")):
+            try:
+                with open(entry.path, "r", encoding="ascii") as file:
+                    key = file.read().strip()
+            except OSError:
+                continue
+            if not os.path.exists(os.path.join(self.cache_dir, f"{key}.b64")):
+                os.remove(entry.path)
+        return total
+
+
+image_cache = ImageCache(
+    IMAGE_CONFIG["cache_max_bytes"],
+    cache_dir=IMAGE_CONFIG["cache_dir"],
+    dir_max_bytes=IMAGE_CONFIG["cache_dir_max_bytes"],
+    variant_policy=IMAGE_CONFIG["variant_policy"],
+    max_dimension=IMAGE_CONFIG["variant_max_dimension"],
+    variant_format=IMAGE_CONFIG["variant_format"],
+    quality=IMAGE_CONFIG["variant_quality"],
+)
+
+
+def _is_image_attachment(attachment: discord.Attachment) -> bool:
+    if attachment.content_type:
+        return attachment.content_type.startswith("image/")
+    mime, _ = mimetypes.guess_type(attachment.filename)
+    return bool(mime and mime.startswith("image/"))
+
+
+async def _attachment_to_data_url(attachment: discord.Attachment) -> str:
+    cached = await image_cache.get(attachment.id)
+    if cached is not None:
+        return cached
+
+    if attachment.size and attachment.size > MAX_IMAGE_BYTES:
+        return ""
+
+    started = time.perf_counter()
+    try:
+        with span("image_fetch", bytes=attachment.size):
+            image_bytes = await attachment.read()
+    except discord.HTTPException:
+        return ""
+    IMAGE_FETCH_SECONDS.observe(time.perf_counter() - started)
+
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        return ""
+
+    mime_type = attachment.content_type or mimetypes.guess_type(attachment.filename)[0] or "application/octet-stream"
+    # Hashing, downscaling and encoding run in a worker thread
+    started = time.perf_counter()
+    with span("image_encode"):
+        data_url = await image_cache.add(attachment.id, image_bytes, mime_type)
+    IMAGE_ENCODE_SECONDS.observe(time.perf_counter() - started)
+    return data_url
+
+
+def _encode_data_url(image_bytes: bytes, mime_type: str) -> str:
+    encoded = base64.b64encode(image_bytes).decode("ascii")
+    return f"data:{mime_type};base64,{encoded}"
+
+
+async def _collect_images(attachments) -> List[tuple]:
+    """
+    Fetch and encode the image attachments of a message concurrently.
+    Images are taken in order until the per-message byte budget is used up.
+    Returns (description, data_url) pairs for the images that made it.
+    """
+    selected = []
+    budget = MAX_MESSAGE_IMAGE_BYTES
+    for attachment in attachments:
+        if not _is_image_attachment(attachment):
+            continue
+        size = attachment.size or 0
+        if size > budget:
+            continue
+        budget -= size
+        selected.append(attachment)
+
+    if not selected:
+        return []
+
+    results = await asyncio.gather(*(_attachment_to_data_url(a) for a in selected), return_exceptions=True)
+    images = []
+    for attachment, data_url in zip(selected, results):
+        if isinstance(data_url, BaseException):
+            print(f"❌ Lỗi tải ảnh {attachment.filename}: {data_url}")
+            continue
+        if data_url:
+            images.append((attachment.filename or "Hình ảnh", data_url))
+    return images
+
+
+def _build_memory_message(base_text: str, image_descriptions: List[str]) -> str:
+    parts = []
+    if base_text and base_text.strip():
+        parts.append(base_text.strip())
+    for desc in image_descriptions:
+        parts.append(f"[🖼️ {desc}]")
+    if not parts:
+        return "[🖼️ Người dùng đã gửi hình ảnh]"
+    return "\n".join(parts)
+
+
+# ----------------------------
+# Context builder
+# ----------------------------
+def estimate_tokens(text: str) -> int:
+    # About 4 bytes of UTF-8 per token holds up for English and Vietnamese alike
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def _make_tokenizer(name: str):
+    if ":" in name:
+        module_name, _, attr = name.partition(":")
+        return getattr(importlib.import_module(module_name), attr)(MODEL_NAME)
+    if name in ("auto", "tiktoken") and tiktoken is not None:
+        try:
+            encoding = tiktoken.encoding_for_model(MODEL_NAME)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    if name == "tiktoken":
+        print("⚠️ tiktoken chưa được cài, dùng ước lượng token.")
+    elif name not in ("auto", "estimate"):
+        print(f"⚠️ Không biết tokenizer \"{name}\", dùng ước lượng token.")
+    return estimate_tokens
+
+
+class ContextBuilder:
+    """
+    Picks which stored history messages go into a request.
+
+    History is taken newest-first until the model's token budget is used up,
+    with each message's token count cached on the message itself. With the
+    prompt cache enabled the window is sticky: it keeps starting at the same
+    message while it fits, and when it no longer does it restarts at only
+    reanchor_fill of the budget, leaving room to grow for the next turns
+    without changing the prefix. Anchors are kept for the max_users most
+    recently active users; anyone else just re-anchors on their next turn.
+    """
+
+    def __init__(self, budgets: dict, tokenizer=estimate_tokens, reanchor_fill: float = 0.6, max_users: int = 4096):
+        self.budgets = budgets
+        self.tokenizer = tokenizer
+        self.reanchor_fill = reanchor_fill
+        self.max_users = max_users
+        self._anchors = OrderedDict()
+
+    def budget_for(self, model: str) -> int:
+        return self.budgets.get(model, self.budgets.get("default", 2000))
+
+    def count(self, message: StoredMessage) -> int:
+        tokens = message.tokens
+        if tokens is None:
+            content = message.content
+            if isinstance(content, str):
+                tokens = self.tokenizer(content)
+            else:
+                tokens = sum(self.tokenizer(part.get("text", "")) for part in content)
+            # Role and separator tokens of the chat template
+            tokens += 4
+            message.tokens = tokens
+        return tokens
+
+    def _fit(self, history, budget) -> int:
+        total = 0
+        start = len(history)
+        for i in range(len(history) - 1, -1, -1):
+            cost = self.count(history[i])
+            # The newest message always goes in, even on its own it is over budget
+            if total + cost > budget and start < len(history):
+                break
+            total += cost
+            start = i
+        # Never open the window on an assistant turn; sanitize_messages would drop it
+        while start < len(history) - 1 and history[start].role != "user":
+            start += 1
+        return start
+
+    def select(self, user_id, history, model: str, sticky: bool = False) -> list:
+        history = list(history)
+        if not history:
+            return []
+        budget = self.budget_for(model)
+        if not sticky:
+            return history[self._fit(history, budget):]
+
+        anchor = self._anchors.get(user_id)
+        start = next((i for i, message in enumerate(history) if message is anchor), None)
+        if start is None or sum(self.count(message) for message in history[start:]) > budget:
+            start = self._fit(history, int(budget * self.reanchor_fill))
+            self._anchors[user_id] = history[start]
+            if len(self._anchors) > self.max_users:
+                self._anchors.popitem(last=False)
+        self._anchors.move_to_end(user_id)
+        return history[start:]
+
+    def forget(self, user_id=None) -> None:
+        if user_id is None:
+            self._anchors.clear()
+        else:
+            self._anchors.pop(user_id, None)
+
+
+context_builder = ContextBuilder(
+    CONTEXT_CONFIG["history_tokens"],
+    tokenizer=_make_tokenizer(CONTEXT_CONFIG["tokenizer"]),
+    reanchor_fill=CONTEXT_CONFIG["reanchor_fill"],
+)
+
+
+def _fold_into_summary(record: dict, evicted: StoredMessage) -> None:
+    """Keep a short rolling digest of turns that fell out of stored history."""
+    text = evicted.content if isinstance(evicted.content, str) else ""
+    line = " ".join(text.split())[:160]
+    if not line:
+        return
+    speaker = "Bot" if evicted.role == "assistant" else "User"
+    summary = f"{record.get('summary', '')}\n{speaker}: {line}".strip()
+    limit = CONTEXT_CONFIG["summary_max_chars"]
+    if len(summary) > limit:
+        summary = summary[-limit:].split("\n", 1)[-1]
+    record["summary"] = summary
+
+
+# ----------------------------
+# Long-term memory
+# ----------------------------
+_WORD_RE = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """
+    Words and word pairs hashed into dim signed buckets, L2-normalised so a
+    dot product is a cosine similarity. No model or vocabulary to download,
+    and the same text gets the same vector in every process.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed(self, texts) -> "np.ndarray":
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _WORD_RE.findall(text.lower())
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            if not features:
+                continue
+            hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+            signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dim, signs)
+        # Damp repeated words so one long turn does not match everything
+        np.copysign(np.log1p(np.abs(vectors)), vectors, out=vectors)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors /= norms
+        return vectors
+
+
+def _make_embedder(name: str, dim: int):
+    if name == "hashing":
+        return HashingEmbedder(dim)
+    module_name, _, attr = name.partition(":")
+    return getattr(importlib.import_module(module_name), attr)(dim)
+
+
+def _chunk_text(text: str, limit: int) -> List[str]:
+    chunks = []
+    text = text.strip()
+    while len(text) > limit:
+        cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class _UserIndex:
+    __slots__ = ("vectors", "offsets", "turns", "stamp")
+
+    def __init__(self):
+        self.vectors = None  # memmap of (rows, dim) float32
+        self.offsets = []    # byte offset of each row's line in the text file
+        self.turns = []      # exchange number of each row, ascending
+        self.stamp = None    # (inode, size) of the vector file as last seen
+
+
+class LongTermMemory:
+    """
+    Older conversation turns, embedded and searched by similarity.
+
+    Every finished exchange is split into snippets of at most snippet_chars,
+    embedded, and appended to two files per user under directory: <user>.f32
+    holds the vectors as raw float32 rows and <user>.jsonl the snippet texts
+    with the number of the exchange they came from. A search memory-maps the
+    vector file and scores every row with one matrix product, so the vectors
+    live in the page cache and only the top_k hits' texts are read back. At
+    most open_users indexes stay mapped; past max_snippets a user's oldest
+    snippets are dropped. All file work runs on one worker thread.
+
+    Shard processes each write to their own directory under root. forget()
+    deletes from all of them, and an open index whose vector file was
+    replaced or deleted by another process is reloaded before it is used.
+    """
+
+    def __init__(self, directory, embedder, top_k=3, min_score=0.2, snippet_chars=600,
+                 max_snippets=5000, open_users=256, root=None):
+        self.directory = directory
+        self.root = root or directory
+        self.embedder = embedder
+        self.dim = embedder.dim
+        self.top_k = top_k
+        self.min_score = min_score
+        self.snippet_chars = snippet_chars
+        self.max_snippets = max_snippets
+        self.open_users = open_users
+        self._open = OrderedDict()  # user_id -> _UserIndex
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="longterm-memory")
+        os.makedirs(directory, exist_ok=True)
+
+    # Worker thread side
+    @staticmethod
+    def _file_names(user_id):
+        base = re.sub(r"[^\w-]", "_", str(user_id))
+        return f"{base}.f32", f"{base}.jsonl"
+
+    def _paths(self, user_id):
+        return tuple(os.path.join(self.directory, name) for name in self._file_names(user_id))
+
+    def _directories(self) -> List[str]:
+        """root and every shard directory in it, whichever process wrote them."""
+        directories = [self.root, self.directory]
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                path = os.path.join(self.root, name)
+                if name.startswith("shard") and os.path.isdir(path):
+                    directories.append(path)
+        return list(dict.fromkeys(directories))
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size
+
+    def _map(self, user_id, index) -> None:
+        vector_path, _ = self._paths(user_id)
+        rows = len(index.offsets)
+        index.vectors = np.memmap(vector_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+        index.stamp = self._stamp(vector_path)
+
+    def _index(self, user_id) -> _UserIndex:
+        index = self._open.get(user_id)
+        if index is not None:
+            # Another process may have purged the user since we loaded them
+            if index.stamp == self._stamp(self._paths(user_id)[0]):
+                self._open.move_to_end(user_id)
+                return index
+            del self._open[user_id]
+
+        vector_path, text_path = self._paths(user_id)
+        index = _UserIndex()
+        end = 0
+        if os.path.exists(text_path):
+            with open(text_path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    index.offsets.append(end)
+                    index.turns.append(json_loads(line)["turn"])
+                    end += len(line)
+        row_bytes = 4 * self.dim
+        vector_rows = os.path.getsize(vector_path) // row_bytes if os.path.exists(vector_path) else 0
+
+        # Texts are written before vectors, so a crash mid-append leaves extra
+        # texts (dropped here); extra vectors can only come from a compaction
+        # that replaced the texts but not the vectors, and belong at the end.
+        if vector_rows > len(index.offsets):
+            with open(vector_path, "rb") as file:
+                file.seek((vector_rows - len(index.offsets)) * row_bytes)
+                tail = file.read()
+            self._replace(vector_path, tail)
+        elif vector_rows < len(index.offsets):
+            end = index.offsets[vector_rows]
+            del index.offsets[vector_rows:]
+            del index.turns[vector_rows:]
+        if os.path.exists(text_path) and os.path.getsize(text_path) != end:
+            os.truncate(text_path, end)
+        if os.path.exists(vector_path) and os.path.getsize(vector_path) != len(index.offsets) * row_bytes:
+            os.truncate(vector_path, len(index.offsets) * row_bytes)
+
+        self._map(user_id, index)
+        self._open[user_id] = index
+        while len(self._open) > self.open_users:
+            self._open.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _replace(path, data: bytes) -> None:
+        tmp_name = f"{path}.tmp"
+        with open(tmp_name, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_name, path)
+
+    def _add(self, user_id, snippets) -> None:
+        vectors = np.ascontiguousarray(self.embedder.embed(snippets), dtype=np.float32)
+        index = self._index(user_id)
+        turn = index.turns[-1] + 1 if index.turns else 0
+        vector_path, text_path = self._paths(user_id)
+        with open(text_path, "ab") as file:
+            offset = file.tell()
+            for snippet in snippets:
+                line = json.dumps({"turn": turn, "text": snippet}, ensure_ascii=False).encode("utf-8") + b"\n"
+                file.write(line)
+                index.offsets.append(offset)
+                index.turns.append(turn)
+                offset += len(line)
+        with open(vector_path, "ab") as file:
+            file.write(vectors.tobytes())
+        if len(index.offsets) > self.max_snippets:
+            self._compact(user_id, index)
+        else:
+            self._map(user_id, index)
+
+    def _compact(self, user_id, index) -> None:
+        # Drop a tenth more than needed so this does not run on every exchange
+        first = len(index.offsets) - (self.max_snippets - self.max_snippets // 10)
+        vector_path, text_path = self._paths(user_id)
+        with open(text_path, "rb") as file:
+            file.seek(index.offsets[first])
+            texts = file.read()
+        with open(vector_path, "rb") as file:
+            file.seek(first * 4 * self.dim)
+            vectors = file.read()
+        index.vectors = None
+        self._replace(text_path, texts)
+        self._replace(vector_path, vectors)
+        self._open.pop(user_id, None)
+
+    def _search(self, user_id, query: str, skip_turns: int) -> List[str]:
+        index = self._index(user_id)
+        if index.vectors is None:
+            return []
+        # The newest exchanges are still in the history window of the request
+        rows = len(index.offsets)
+        if skip_turns > 0:
+            rows = bisect.bisect_right(index.turns, index.turns[-1] - skip_turns)
+        if rows == 0:
+            return []
+
+        scores = index.vectors[:rows] @ self.embedder.embed([query])[0]
+        k = min(self.top_k, rows)
+        top = np.argpartition(scores, rows - k)[rows - k:]
+        hits = sorted(int(i) for i in top if scores[i] >= self.min_score)
+        if not hits:
+            return []
+        _, text_path = self._paths(user_id)
+        texts = []
+        with open(text_path, "rb") as file:
+            for i in hits:
+                file.seek(index.offsets[i])
+                texts.append(json_loads(file.readline())["text"])
+        return texts
+
+    def _forget(self, user_id=None) -> bool:
+        if user_id is None:
+            self._open.clear()
+        else:
+            self._open.pop(user_id, None)
+        removed = False
+        for directory in self._directories():
+            if user_id is None:
+                names = [name for name in os.listdir(directory) if name.endswith((".f32", ".jsonl"))]
+            else:
+                names = self._file_names(user_id)
+            for name in names:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                removed = True
+        return removed
+
+    # Event loop side
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def remember(self, user_id, user_text: str, reply: str) -> None:
+        snippets = _chunk_text(f"{user_text.strip()}\nBot: {reply.strip()}", self.snippet_chars)
+        try:
+            await self._call(self._add, user_id, snippets)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Không lưu được trí nhớ dài hạn của {user_id}: {e}")
+
+    async def recall(self, user_id, query: str, skip_turns: int = 0) -> List[str]:
+        if not query.strip():
+            return []
+        try:
+            return await self._call(self._search, user_id, query, skip_turns)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Không đọc được trí nhớ dài hạn của {user_id}: {e}")
+            return []
+
+    async def forget(self, user_id=None) -> bool:
+        return await self._call(self._forget, user_id)
+
+    async def close(self):
+        await self._call(self._open.clear)
+        self._executor.shutdown(wait=True)
+
+
+def _make_long_term_memory():
+    if not LONGTERM_CONFIG["enabled"]:
+        return None
+    if np is None:
+        print("⚠️ numpy chưa được cài, tắt trí nhớ dài hạn.")
+        return None
+    root = LONGTERM_CONFIG["dir"]
+    directory = os.path.join(root, f"shard{SHARD_IDS[0]}") if SHARD_IDS else root
+    return LongTermMemory(
+        directory,
+        _make_embedder(LONGTERM_CONFIG["embedder"], LONGTERM_CONFIG["dim"]),
+        top_k=LONGTERM_CONFIG["top_k"],
+        min_score=LONGTERM_CONFIG["min_score"],
+        snippet_chars=LONGTERM_CONFIG["snippet_chars"],
+        max_snippets=LONGTERM_CONFIG["max_snippets"],
+        open_users=LONGTERM_CONFIG["open_users"],
+        root=root,
+    )
+
+
+long_term_memory = _make_long_term_memory()
+
+
+# ----------------------------
+# Memory management
+# ----------------------------
+async def update_memory(user_id, username, message, role):
+    if role == "user":
+        prefix = f"{username}:"
+        if message.strip().startswith(prefix):
+            new_content = message
+        else:
+            new_content = f"{username}: {message}"
+    else:
+        new_content = message
+
+    with span("update_memory", role=role):
+        await conversation_store.append(user_id, username, StoredMessage(role, new_content))
+
+
+# ---------------------------- 
+# Sanitizer (to be compatible with the new llama.cpp)      
+# ----------------------------                                                                       
+def sanitize_messages(messages):
+    """
+    Hàm này đảm bảo:
+    1. Không bao giờ có 2 role giống nhau đứng cạnh nhau (merge content lại).
+    2. Message đầu tiên sau System PHẢI là User (nếu là Assistant thì xóa).
+    """
+    if not messages:
+        return []
+
+    sanitized = []
+    
+    # Tách system ra (nếu có)
+    has_system = messages[0]["role"] == "system"
+    start_index = 1 if has_system else 0
+    
+    if has_system:
+        sanitized.append(messages[0])
+
+    # Xử lý phần còn lại
+    temp_messages = messages[start_index:]
+    
+    # Bỏ qua các tin nhắn Assistant ở đầu (nếu bị cắt mất User tương ứng)
+    while temp_messages and temp_messages[0]["role"] == "assistant":
+        temp_messages.pop(0)
+
+    for msg in temp_messages:
+        if not sanitized:
+            sanitized.append(msg)
+            continue
+
+        last_msg = sanitized[-1]
+
+        # Nếu role trùng nhau -> Merge content
+        # Nếu role trùng nhau -> Merge content
+        if last_msg["role"] == msg["role"]:
+            old_content = last_msg["content"]
+            new_content = msg["content"]
+
+            # --- FIX: NẾU CÓ CHỨA ẢNH (LIST), PHẢI MERGE CHUẨN JSON VISION ---
+            if isinstance(old_content, str) and isinstance(new_content, str):
+                # Nếu cả 2 đều là chữ thường, nối chuỗi bình thường
+                last_msg["content"] = f"{old_content}\n\n{new_content}"
+            else:
+                # Ép tất cả về dạng List chuẩn OpenAI
+                old_list = [{"type": "text", "text": old_content}] if isinstance(old_content, str) else old_content
+                new_list = [{"type": "text", "text": new_content}] if isinstance(new_content, str) else new_content
+        
+                # Cộng 2 mảng lại với nhau đéo làm mất cấu trúc Base64
+                last_msg["content"] = old_list + new_list
+        else:
+            sanitized.append(msg)
+            
+    return sanitized
+
+
+# ----------------------------
+# Request body
+# ----------------------------
+def _as_content_list(content) -> list:
+    return [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+
+
+def _merge_turns(previous: dict, new_content) -> dict:
+    """Merge the content of a consecutive same-role message the way sanitize_messages does."""
+    old_content = previous["content"]
+    if isinstance(old_content, str) and isinstance(new_content, str):
+        return {"role": previous["role"], "content": f"{old_content}\n\n{new_content}"}
+    return {"role": previous["role"], "content": _as_content_list(old_content) + _as_content_list(new_content)}
+
+
+def _serialize_message(message: dict) -> list:
+    """
+    JSON-encode one chat message into chunks. Large image data URLs that
+    need no JSON escaping (base64 never does) are kept as chunks of their
+    own, so they are written to the socket as they are instead of being
+    copied into one big request string.
+    """
+    content = message["content"]
+    if isinstance(content, str):
+        return [json.dumps({"role": message["role"], "content": content}, ensure_ascii=False).encode("utf-8")]
+
+    chunks = [b'{"role":' + json.dumps(message["role"]).encode("utf-8") + b',"content":[']
+    for i, item in enumerate(content):
+        if i:
+            chunks.append(b",")
+        url = item.get("image_url", {}).get("url", "") if item.get("type") == "image_url" else ""
+        header, base64_marker, _ = url[:256].partition(";base64,")
+        if base64_marker and url.isascii() and json.dumps(header) == f'"{header}"':
+            chunks.append(b'{"type":"image_url","image_url":{"url":"')
+            chunks.append(url)
+            chunks.append(b'"}}')
+        else:
+            chunks.append(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+    chunks.append(b"]}")
+    return chunks
+
+
+class _PrefixEntry:
+    __slots__ = ("system", "system_chunks", "groups", "tail", "tail_first", "last")
+
+    def __init__(self):
+        self.system = None
+        self.system_chunks = []
+        self.groups = []  # (first message, serialized chunks) of every finished sanitized message
+        self.tail = None  # last sanitized message, still open to merging
+        self.tail_first = None
+        self.last = None  # last history message folded in
+
+
+class PayloadCache:
+    """
+    Per-user cache of the sanitized, serialized history of a request.
+
+    sanitize_messages is a left fold that merges runs of same-role messages,
+    so every finished run serializes the same way in any window that
+    contains it whole. Each run is serialized once and kept keyed by its
+    first stored message; a new window reuses the runs from its first
+    message on and only folds in messages newer than the last one seen.
+    Only the final run stays unserialized, since the next message (or the
+    new user turn) may still merge into it. A window that starts in the
+    middle of a run, or no longer contains the last folded message, is
+    rebuilt from scratch.
+    """
+
+    def __init__(self, max_users=4096):
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _resume(entry, history):
+        """Index of the first message still to fold into entry, or None when entry can't be reused."""
+        end = next((i for i in range(len(history) - 1, -1, -1) if history[i] is entry.last), None)
+        if end is None:
+            return None
+        first = next((message for message in history if message.role != "assistant"), None)
+        if first is entry.tail_first:
+            entry.groups = []
+            return end + 1
+        for i, (group_first, _) in enumerate(entry.groups):
+            if group_first is first:
+                del entry.groups[:i]
+                return end + 1
+        return None
+
+    def messages(self, user_id, system_prompt: str, history: list, user_turn: dict = None) -> list:
+        """Chunks of the sanitized "messages" array items for history followed by user_turn, if any."""
+        entry = self._entries.get(user_id)
+        start = self._resume(entry, history) if entry is not None and history else None
+        if start is None:
+            self.misses += 1
+            previous = entry
+            entry = _PrefixEntry()
+            if previous is not None:
+                entry.system, entry.system_chunks = previous.system, previous.system_chunks
+            self._entries[user_id] = entry
+            if len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+            start = 0
+        else:
+            self.hits += 1
+        self._entries.move_to_end(user_id)
+
+        if entry.system != system_prompt:
+            entry.system = system_prompt
+            entry.system_chunks = _serialize_message({"role": "system", "content": system_prompt}) if system_prompt.strip() else []
+
+        for message in history[start:]:
+            if entry.tail is None:
+                if message.role == "assistant":
+                    # Assistant replies whose user turn was trimmed away are dropped
+                    continue
+                entry.tail, entry.tail_first = message.to_json(), message
+            elif entry.tail["role"] == message.role:
+                entry.tail = _merge_turns(entry.tail, message.content)
+            else:
+                entry.groups.append((entry.tail_first, _serialize_message(entry.tail)))
+                entry.tail, entry.tail_first = message.to_json(), message
+        if history:
+            entry.last = history[-1]
+
+        parts = [entry.system_chunks] if entry.system_chunks else []
+        parts.extend(group_chunks for _, group_chunks in entry.groups)
+        if user_turn is not None and entry.tail is not None and entry.tail["role"] == user_turn["role"]:
+            parts.append(_serialize_message(_merge_turns(entry.tail, user_turn["content"])))
+        else:
+            if entry.tail is not None:
+                parts.append(_serialize_message(entry.tail))
+            if user_turn is not None:
+                parts.append(_serialize_message(user_turn))
+
+        chunks = []
+        for part in parts:
+            if chunks:
+                chunks.append(b",")
+            chunks.extend(part)
+        return chunks
+
+    def forget(self, user_id=None) -> None:
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+
+payload_cache = PayloadCache()
+
+
+class RequestBody:
+    """
+    A chat completion request: pre-serialized "messages" chunks plus the
+    small scalar parameters, which are re-encoded on every attempt since
+    retries may change the model or drop prompt-cache fields.
+    """
+
+    def __init__(self, message_chunks: list, params: dict):
+        self.message_chunks = message_chunks
+        self.params = params
+
+    def chunks(self) -> list:
+        params = json.dumps(self.params, ensure_ascii=False).encode("utf-8")
+        return [b'{"messages":[', *self.message_chunks, b"]," + params[1:]]
+
+    def post(self, session, url, headers):
+        chunks = self.chunks()
+
+        async def stream():
+            for chunk in chunks:
+                yield chunk if isinstance(chunk, bytes) else chunk.encode("ascii")
+
+        # A known Content-Length keeps the upload un-chunked for servers that don't accept chunked bodies
+        size = sum(len(chunk) for chunk in chunks)
+        return session.post(url, data=stream(), headers={**headers, "Content-Length": str(size)})
+
+
+# ----------------------------
+# Prompt cache affinity
+# ----------------------------
+class PromptCacheAffinity:
+    """
+    Pins each user's conversation to one llama.cpp server slot.
+
+    llama.cpp only reuses the KV cache of a prompt prefix that is still
+    loaded in the slot the request lands on, so every user keeps the same
+    id_slot between turns. When there are more active users than slots, the
+    least recently active user gives up theirs.
+    A backend that rejects the extra fields stops getting them (its
+    prompt_cache flag is cleared by _post_completion).
+    """
+
+    def __init__(self, enabled: bool, slots: int):
+        self.enabled = enabled and slots > 0
+        self.slots = slots
+        self._owners = OrderedDict()
+
+    def slot_for(self, user_id) -> int:
+        slot = self._owners.get(user_id)
+        if slot is not None:
+            self._owners.move_to_end(user_id)
+            return slot
+        if len(self._owners) < self.slots:
+            slot = len(self._owners)
+        else:
+            _, slot = self._owners.popitem(last=False)
+        self._owners[user_id] = slot
+        return slot
+
+    def apply(self, payload: dict, user_id, backend) -> None:
+        if self.enabled and backend.prompt_cache:
+            payload["cache_prompt"] = True
+            payload["id_slot"] = self.slot_for(user_id)
+        else:
+            payload.pop("cache_prompt", None)
+            payload.pop("id_slot", None)
+
+
+prompt_cache = PromptCacheAffinity(PROMPT_CACHE_CONFIG["enabled"], PROMPT_CACHE_CONFIG["slots"])
+
+
+# ----------------------------
+# LLM backend pool
+# ----------------------------
+class Backend:
+    __slots__ = ("name", "url", "model", "api_key", "requires_key", "weight", "health_url", "prewarm",
+                 "prompt_cache", "in_flight", "failures", "ejected_until", "ttft")
+
+    def __init__(self, url, model, api_key, weight=1.0, health_url="", name=None, prewarm=True, requires_key=False):
+        self.name = name or url
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.requires_key = requires_key  # refuse to send without api_key (the OpenAI default endpoint)
+        self.weight = max(float(weight), 0.001)
+        self.health_url = health_url
+        self.prewarm = prewarm  # accepts prompt-only requests; cleared when it rejects one
+        self.prompt_cache = True  # accepts cache_prompt/id_slot; cleared when it rejects them
+        self.in_flight = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.ttft = None  # moving average of time to first token, seconds
+
+    def load(self) -> float:
+        return (self.in_flight + 1) / self.weight
+
+
+class BackendFailed(Exception):
+    """A backend failed before streaming anything, so the request may go elsewhere."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class BackendPool:
+    """
+    Routes each generation to one of several OpenAI-compatible backends.
+
+    A request goes to the backend with the fewest in-flight generations per
+    unit of weight, ties broken by the lower moving average of time to first
+    token. A backend that answers 5xx, drops the connection or times out
+    eject_after times in a row is ejected for eject_seconds; backends with a
+    health_url are also probed every health_interval seconds, which ejects
+    and re-admits them between requests. When every backend is ejected the
+    one due back soonest is still tried rather than failing the reply.
+    With the prompt cache on, users stick to their last backend while it is
+    not more loaded than the best choice, so their KV cache stays warm.
+    """
+
+    def __init__(self, backends, eject_after=1, eject_seconds=30, health_interval=10, health_timeout=5,
+                 max_attempts=2, sticky=False, max_users=4096):
+        self.backends = backends
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.sticky = sticky
+        self.max_users = max_users
+        self._affinity = OrderedDict()
+        self._task = None
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [
+            {
+                "name": b.name,
+                "in_flight": b.in_flight,
+                "healthy": b.ejected_until <= now,
+                "ttft": b.ttft,
+            }
+            for b in self.backends
+        ]
+
+    def pick(self, user_id, exclude=()):
+        """Choose and reserve a backend; every backend returned must be given back with release()."""
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healthy = [b for b in candidates if b.ejected_until <= now]
+        if not healthy:
+            best = min(candidates, key=lambda b: b.ejected_until)
+        else:
+            best = min(healthy, key=lambda b: (b.load(), b.ttft or 0.0))
+            if self.sticky:
+                previous = self._affinity.get(user_id)
+                if previous in healthy and previous.load() <= best.load():
+                    best = previous
+                self._affinity[user_id] = best
+                self._affinity.move_to_end(user_id)
+                if len(self._affinity) > self.max_users:
+                    self._affinity.popitem(last=False)
+        best.in_flight += 1
+        return best
+
+    def release(self, backend) -> None:
+        backend.in_flight -= 1
+
+    def report_success(self, backend, ttft=None) -> None:
+        backend.failures = 0
+        if ttft is not None:
+            backend.ttft = ttft if backend.ttft is None else 0.8 * backend.ttft + 0.2 * ttft
+
+    def report_failure(self, backend, reason: str) -> None:
+        backend.failures += 1
+        if backend.failures >= self.eject_after:
+            self._eject(backend, reason)
+
+    def _eject(self, backend, reason: str) -> None:
+        if backend.ejected_until <= time.monotonic():
+            print(f"⚠️ Tạm ngưng backend {backend.name} trong {self.eject_seconds}s: {reason}")
+        backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    def _readmit(self, backend) -> None:
+        backend.failures = 0
+        backend.ejected_until = 0.0
+
+    async def _probe(self, backend) -> None:
+        try:
+            async with get_http_session().get(
+                backend.health_url,
+                timeout=aiohttp.ClientTimeout(total=self.health_timeout),
+            ) as resp:
+                healthy = resp.status == 200
+                reason = f"health check {resp.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            healthy = False
+            reason = f"health check {e!r}"
+        if healthy:
+            self._readmit(backend)
+        else:
+            self._eject(backend, reason)
+
+    async def _run(self):
+        probed = [b for b in self.backends if b.health_url]
+        while True:
+            await asyncio.gather(*(self._probe(b) for b in probed))
+            await asyncio.sleep(self.health_interval)
+
+    def start(self) -> None:
+        if self._task is None and self.health_interval > 0 and any(b.health_url for b in self.backends):
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def _load_backends(entries):
+    # No "backends" list: the single api_endpoint / model_name / OPENAI_API_KEY setup,
+    # which needs a key; listed backends (e.g. llama.cpp) may run without one
+    requires_key = not entries
+    entries = entries or [{"url": OPENAI_API_URL}]
+    backends = []
+    for entry in entries:
+        api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env") or "OPENAI_API_KEY", "")
+        backends.append(Backend(
+            entry["url"],
+            entry.get("model", MODEL_NAME),
+            api_key,
+            weight=entry.get("weight", 1),
+            health_url=entry.get("health_url", ""),
+            name=entry.get("name"),
+            prewarm=entry.get("prewarm", True),
+            requires_key=requires_key,
+        ))
+    return backends
+
+
+backend_pool = BackendPool(
+    _load_backends(config["backends"]),
+    sticky=prompt_cache.enabled,
+    **config["backend_pool"],
+)
+
+
+async def _post_completion(session, backend, body, headers):
+    """
+    POST a chat completion and return the response once its headers arrive.
+    A 400 on a request carrying prompt-cache fields is retried without them,
+    for OpenAI-compatible backends that reject unknown parameters. Only when
+    that retry gets past the 400 is the prompt cache turned off for the
+    backend; a 400 either way (say, a prompt over the context size) is the
+    request's fault, not the fields'.
+    """
+    rejected = None
+    while True:
+        # Bound the wait for response headers separately from the streaming reads
+        resp = await asyncio.wait_for(
+            body.post(session, backend.url, headers),
+            timeout=HTTP_CONFIG["first_byte_timeout"],
+        )
+        if resp.status != 400 and rejected is not None and backend.prompt_cache:
+            backend.prompt_cache = False
+            print(f"⚠️ Backend {backend.name} không hỗ trợ cache_prompt/id_slot, tắt prompt cache cho backend này: {rejected}")
+        if resp.status != 400 or "cache_prompt" not in body.params:
+            return resp
+        rejected = (await resp.text())[:200]
+        resp.release()
+        body.params.pop("cache_prompt", None)
+        body.params.pop("id_slot", None)
+
+
+# ----------------------------
+# Streaming parser
+# ----------------------------
+class SSEParser:
+    """
+    Incremental Server-Sent Events parser.
+
+    Raw network chunks go through an incremental UTF-8 decoder, so characters
+    split across chunks are reassembled instead of failing to decode, and are
+    framed into events on blank lines as the SSE spec describes. feed()
+    returns the data payloads of the events completed by that chunk.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._line_parts = []
+        self._data_lines = []
+        self._pending_cr = False
+
+    def feed(self, raw: bytes) -> List[str]:
+        text = self._decoder.decode(raw)
+        if not text:
+            return []
+        if self._pending_cr and text.startswith("\n"):
+            text = text[1:]
+        self._pending_cr = text.endswith("\r")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+        events = []
+        lines = text.split("\n")
+        # The last piece is an unfinished line; keep it for the next chunk
+        for piece in lines[:-1]:
+            if self._line_parts:
+                self._line_parts.append(piece)
+                piece = "".join(self._line_parts)
+                self._line_parts = []
+            self._handle_line(piece, events)
+        if lines[-1]:
+            self._line_parts.append(lines[-1])
+        return events
+
+    def close(self) -> List[str]:
+        """Flush whatever is left when the stream ends without a final blank line."""
+        events = []
+        tail = self._decoder.decode(b"", final=True)
+        if tail:
+            self._line_parts.append(tail)
+        if self._line_parts:
+            self._handle_line("".join(self._line_parts), events)
+            self._line_parts = []
+        self._handle_line("", events)
+        return events
+
+    def _handle_line(self, line: str, events: List[str]) -> None:
+        if not line:
+            if self._data_lines:
+                events.append("\n".join(self._data_lines))
+                self._data_lines = []
+            return
+        if line.startswith(":"):
+            return
+        field, _, value = line.partition(":")
+        if field == "data":
+            self._data_lines.append(value[1:] if value.startswith(" ") else value)
+
+
+class StreamAssembler:
+    """
+    Turns streamed text deltas into sendable pieces.
+
+    Deltas are kept in a chunk list and only the newly arrived text is
+    scanned, so assembling an answer is linear in its length. Complete lines
+    are released one by one, and fenced code blocks are held back until their
+    closing fence arrives so they are released whole.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._line_parts = []
+        self._block_lines = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def feed(self, delta: str) -> List[str]:
+        if not delta:
+            return []
+        self._chunks.append(delta)
+        ready = []
+        start = 0
+        newline = delta.find("\n")
+        while newline != -1:
+            self._line_parts.append(delta[start:newline])
+            line = "".join(self._line_parts)
+            self._line_parts = []
+            self._handle_line(line, ready)
+            start = newline + 1
+            newline = delta.find("\n", start)
+        if start < len(delta):
+            self._line_parts.append(delta[start:])
+        return ready
+
+    def finish(self) -> List[str]:
+        ready = []
+        if self._line_parts:
+            self._handle_line("".join(self._line_parts), ready)
+            self._line_parts = []
+        if self._block_lines is not None:
+            block = "\n".join(self._block_lines).strip()
+            if block:
+                ready.append(block)
+            self._block_lines = None
+        return ready
+
+    def _handle_line(self, line: str, ready: List[str]) -> None:
+        toggles = line.count("```") % 2 == 1
+        if self._block_lines is not None:
+            self._block_lines.append(line)
+            if toggles:
+                block = "\n".join(self._block_lines).rstrip()
+                if block.strip():
+                    ready.append(block)
+                self._block_lines = None
+        elif toggles:
+            self._block_lines = [line]
+        elif line.strip():
+            ready.append(line)
+
+
+def _delta_text(data: str) -> str:
+    try:
+        event = json_loads(data)
+    except ValueError as e:
+        print("json load error", e, data)
+        return ""
+    if not isinstance(event, dict):
+        return ""
+
+    choices = event.get("choices") or [{}]
+    delta = (choices[0].get("delta") or {}).get("content")
+    if isinstance(delta, list):
+        return "".join(part.get("text", "") for part in delta if part.get("type") == "text")
+    return delta if isinstance(delta, str) else ""
+
+
+# ----------------------------
+# Recent message cache
+# ----------------------------
+class SeenMessage:
+    __slots__ = ("id", "author_id", "author_name", "content")
+
+    def __init__(self, message_id, author_id, author_name, content):
+        self.id = message_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+
+
+class RecentMessages:
+    """
+    Small LRU of recently seen messages (including the bot's own replies), so
+    resolving the message a user replied to rarely needs a REST call.
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    def remember(self, message, content: str = None) -> SeenMessage:
+        seen = SeenMessage(
+            message.id,
+            message.author.id,
+            message.author.display_name,
+            message.content if content is None else content,
+        )
+        self._items[message.id] = seen
+        self._items.move_to_end(message.id)
+        if len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        return seen
+
+    def get(self, message_id):
+        seen = self._items.get(message_id)
+        if seen is not None:
+            self._items.move_to_end(message_id)
+        return seen
+
+
+recent_messages = RecentMessages(config["recent_message_cache_size"])
+
+
+async def resolve_reference(message):
+    """
+    Return a SeenMessage for the message being replied to, or None if it was deleted.
+    Tries the gateway payload, discord.py's message cache and our own LRU
+    before falling back to fetching it from Discord.
+    """
+    reference = message.reference
+    resolved = reference.resolved
+    if isinstance(resolved, discord.DeletedReferencedMessage):
+        return None
+    if isinstance(resolved, discord.Message):
+        return recent_messages.remember(resolved)
+    if reference.cached_message is not None:
+        return recent_messages.remember(reference.cached_message)
+
+    seen = recent_messages.get(reference.message_id)
+    if seen is not None:
+        return seen
+
+    try:
+        fetched = await message.channel.fetch_message(reference.message_id)
+    except discord.NotFound:
+        return None
+    return recent_messages.remember(fetched)
+
+
+# ----------------------------
+# Discord output
+# ----------------------------
+class ChannelRateLimiter:
+    """
+    Client-side token bucket per channel, shared by every reply in that
+    channel so concurrent replies queue behind each other instead of all
+    running into Discord's per-channel limit and backing off on 429s.
+    """
+
+    def __init__(self, rate: int, per: float, max_channels: int = 1024):
+        self.rate = rate
+        self.per = per
+        self.max_channels = max_channels
+        self._buckets = OrderedDict()
+
+    def _bucket(self, channel_id):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = {"tokens": float(self.rate), "updated": time.monotonic(), "lock": asyncio.Lock()}
+            self._buckets[channel_id] = bucket
+            if len(self._buckets) > self.max_channels:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(channel_id)
+        return bucket
+
+    async def acquire(self, channel_id) -> None:
+        bucket = self._bucket(channel_id)
+        async with bucket["lock"]:
+            while True:
+                now = time.monotonic()
+                refill = (now - bucket["updated"]) * self.rate / self.per
+                bucket["tokens"] = min(float(self.rate), bucket["tokens"] + refill)
+                bucket["updated"] = now
+                if bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    return
+                await asyncio.sleep((1 - bucket["tokens"]) * self.per / self.rate)
+
+
+def _fence_toggles(line: str) -> bool:
+    return line.count("```") % 2 == 1
+
+
+def split_message(text: str, limit: int = 2000) -> List[str]:
+    """
+    Split text into chunks of at most limit characters at line boundaries.
+    A code block cut in two is closed at the end of one chunk and reopened,
+    with its language tag, at the start of the next.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    current = []
+    current_len = 0
+    reopen = None
+    for line in text.split("\n"):
+        toggles = _fence_toggles(line)
+        # Leave room for the fences added around a cut block
+        width = max(1, limit - 16 - (len(reopen) if reopen else 0))
+        pieces = [line[i:i + width] for i in range(0, len(line), width)] or [""]
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            fence_open_after = (reopen is not None) != (toggles and last)
+            needed = current_len + (1 if current else 0) + len(piece) + (4 if fence_open_after else 0)
+            if needed > limit and current:
+                if reopen is not None:
+                    current.append("```")
+                chunks.append("\n".join(current))
+                current = [reopen] if reopen is not None else []
+                current_len = len(reopen) if reopen is not None else 0
+            current_len += (1 if current else 0) + len(piece)
+            current.append(piece)
+        if toggles:
+            reopen = None if reopen is not None else "```" + line[line.rfind("```") + 3:].strip()
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def pack_pieces(pieces: List[str], limit: int = 2000) -> List[str]:
+    """Greedily join pieces with newlines into messages of at most limit characters."""
+    packs = []
+    current = ""
+    for piece in pieces:
+        if len(piece) > limit:
+            if current:
+                packs.append(current)
+                current = ""
+            *full, current = split_message(piece, limit)
+            packs.extend(full)
+        elif not current:
+            current = piece
+        elif len(current) + 1 + len(piece) <= limit:
+            current = f"{current}\n{piece}"
+        else:
+            packs.append(current)
+            current = piece
+    if current:
+        packs.append(current)
+    return packs
+
+
+class ReplyOutput:
+    """
+    Sits between a streamed reply and its channel.
+
+    Lines and whole code blocks pushed in are buffered and flushed once the
+    stream has been quiet for `debounce` seconds (or `max_delay` after the
+    oldest unsent line), packed into as few messages as the character limit
+    allows. In "edit" mode the reply grows inside a single message that is
+    edited on every flush, rolling over to a new one when it fills up.
+    All sends and edits go through the channel's shared rate-limit bucket.
+    """
+
+    def __init__(self, channel, mode: str = None):
+        self.channel = channel
+        self.mode = mode or OUTPUT_CONFIG["mode"]
+        self.limit = OUTPUT_CONFIG["max_message_chars"]
+        self.debounce = OUTPUT_CONFIG["debounce"]
+        self.max_delay = OUTPUT_CONFIG["max_delay"]
+        self.sent_messages = []
+        self.send_count = 0
+        self._pending = []
+        self._pending_len = 0
+        self._first_pending_at = 0.0
+        self._last_push_at = 0.0
+        self._live_message = None
+        self._live_text = ""
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    async def push(self, piece: str) -> None:
+        if not piece.strip():
+            return
+        now = time.monotonic()
+        if not self._pending:
+            self._first_pending_at = now
+        self._last_push_at = now
+        self._pending.append(piece)
+        self._pending_len += len(piece) + 1
+
+        if self._pending_len > self.limit:
+            await self.flush(keep_tail=True)
+        if self._pending and (self._timer is None or self._timer.done()):
+            self._timer = asyncio.create_task(self._flush_when_quiet())
+
+    async def _flush_when_quiet(self):
+        while self._pending:
+            due = min(self._last_push_at + self.debounce, self._first_pending_at + self.max_delay)
+            delay = due - time.monotonic()
+            if delay <= 0:
+                # Shielded so close() cancelling the timer can't drop a half-sent flush
+                await asyncio.shield(self.flush())
+                return
+            await asyncio.sleep(delay)
+
+    async def close(self) -> None:
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+        await self.flush()
+
+    def discard(self) -> None:
+        """Drop text not sent yet, for a reply that was cancelled."""
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+        self._pending = []
+        self._pending_len = 0
+
+    async def flush(self, keep_tail: bool = False) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            pieces = self._pending
+            self._pending = []
+            self._pending_len = 0
+
+            if self.mode == "edit":
+                # _live_text is only ever what Discord accepted for _live_message
+                live_text = self._live_text
+                if live_text:
+                    pieces = [live_text] + pieces
+                packs = pack_pieces(pieces, self.limit)
+                for i, pack in enumerate(packs):
+                    if i == 0 and self._live_message is not None:
+                        delivered = pack == live_text or await self._edit(self._live_message, pack)
+                    else:
+                        message = await self._send(pack)
+                        delivered = message is not None
+                        if delivered:
+                            self._live_message = message
+                    if not delivered:
+                        # Keep the undelivered text for the next flush rather than sending it twice
+                        unsent = packs[i:]
+                        if i == 0 and live_text:
+                            unsent[0] = pack[len(live_text):].lstrip("\n")
+                        self._pending = [piece for piece in unsent if piece] + self._pending
+                        self._pending_len = sum(len(piece) + 1 for piece in self._pending)
+                        self._first_pending_at = time.monotonic()
+                        return
+                    self._live_text = pack
+                return
+
+            packs = pack_pieces(pieces, self.limit)
+            if keep_tail and len(packs) > 1:
+                # The last pack still has room; let the stream keep filling it
+                tail = packs.pop()
+                self._pending = [tail]
+                self._pending_len = len(tail) + 1
+                self._first_pending_at = time.monotonic()
+            for pack in packs:
+                await self._send(pack)
+
+    async def _send(self, content: str):
+        await CHANNEL_RATE_LIMITER.acquire(getattr(self.channel, "id", None))
+        self.send_count += 1
+        started = time.perf_counter()
+        try:
+            with span("discord_send"):
+                message = await self.channel.send(content)
+        except discord.HTTPException as e:
+            print(f"❌ Lỗi gửi tin nhắn: {e}")
+            return None
+        DISCORD_SEND_SECONDS.observe(time.perf_counter() - started)
+        self.sent_messages.append(message)
+        recent_messages.remember(message, content)
+        return message
+
+    async def _edit(self, message, content: str) -> bool:
+        await CHANNEL_RATE_LIMITER.acquire(getattr(self.channel, "id", None))
+        self.send_count += 1
+        started = time.perf_counter()
+        try:
+            with span("discord_edit"):
+                await message.edit(content=content)
+        except discord.NotFound:
+            # Deleted under us: the rest of the reply goes into a new message
+            if message is self._live_message:
+                self._live_message = None
+                self._live_text = ""
+            return False
+        except discord.HTTPException as e:
+            print(f"❌ Lỗi sửa tin nhắn: {e}")
+            return False
+        DISCORD_SEND_SECONDS.observe(time.perf_counter() - started)
+        recent_messages.remember(message, content)
+        return True
+
+
+CHANNEL_RATE_LIMITER = ChannelRateLimiter(OUTPUT_CONFIG["rate_limit_messages"], OUTPUT_CONFIG["rate_limit_per"])
+
+
+# ----------------------------
+# OpenAI streaming response
+# ----------------------------
+def _request_prefix(user_id: str, record: dict, model: str):
+    """The system prompt and history window a request for this user starts with."""
+    conversation_history = context_builder.select(
+        user_id,
+        record.get("messages", []),
+        model,
+        sticky=prompt_cache.enabled
+    )
+
+    system_prompt = SYSTEM_PROMPT
+    summary = record.get("summary", "")
+    if summary:
+        summary_block = f"Tóm tắt các tin nhắn cũ hơn:\n{summary}"
+        system_prompt = f"{system_prompt}\n\n{summary_block}" if system_prompt.strip() else summary_block
+    return system_prompt, conversation_history
+
+
+async def chat_response_stream(prompt, author_name, channel, image_data_urls=None, user_text_override=None):
+    backend = backend_pool.pick(prompt.author.id)
+    # Released only once the reply is done, so concurrent picks see this request's load
+    try:
+        if backend.requires_key and not backend.api_key:
+            await channel.send("❌ Error: OpenAI API key not set.")
+            return ""
+
+        image_data_urls = image_data_urls or []
+        user_text = user_text_override if user_text_override is not None else prompt.content
+        user_text = user_text if user_text is not None else ""
+
+        with span("memory_load"):
+            record = await conversation_store.get(str(prompt.author.id)) or {}
+        build_started = time.perf_counter()
+        system_prompt, conversation_history = _request_prefix(str(prompt.author.id), record, backend.model)
+
+        user_payload = []
+        trimmed_text = user_text.strip()
+        recalled = []
+        if long_term_memory is not None and trimmed_text:
+            # The message itself is already stored, so it is not a past exchange
+            window_turns = sum(1 for message in conversation_history if message.role == "user") - 1
+            with span("memory_recall"):
+                recalled = await long_term_memory.recall(str(prompt.author.id), trimmed_text, skip_turns=window_turns)
+        if recalled:
+            # In the user turn rather than the system prompt, so the cached prefix stays the same
+            user_payload.append({"type": "text", "text": "Trích đoạn liên quan từ các cuộc trò chuyện trước:\n" + "\n---\n".join(recalled)})
+        if trimmed_text:
+            user_payload.append({"type": "text", "text": f"{author_name}: {trimmed_text}"})
+        elif image_data_urls:
+            user_payload.append({"type": "text", "text": f"{author_name} đã gửi {len(image_data_urls)} hình ảnh."})
+
+        if image_data_urls:
+            for data_url in image_data_urls:
+                if data_url:
+                    user_payload.append({"type": "image_url", "image_url": {"url": data_url}})
+
+        if not user_payload:
+            user_payload.append({"type": "text", "text": f"{author_name} sent an empty message."})
+
+        message_chunks = payload_cache.messages(
+            str(prompt.author.id),
+            system_prompt,
+            conversation_history,
+            {"role": "user", "content": user_payload},
+        )
+
+        params = {
+            "model": backend.model,
+            "max_tokens": 4096,
+            "stream": True,
+            "user": str(prompt.author.id),
+            "user_display_name": f"{prompt.author.display_name} ({prompt.author.name})"
+        }
+        body = RequestBody(message_chunks, params)
+        add_span("build_request", build_started)
+
+        entry = _request_entry(prompt)
+        if REQUEST_LOG_CONFIG["include_text"]:
+            entry["text"] = trimmed_text
+        entry["images"] = sum(1 for data_url in image_data_urls if data_url)
+        entry["image_bytes"] = sum(len(data_url) for data_url in image_data_urls)
+        entry["history_messages"] = len(conversation_history)
+        # Text only; image tokens depend on the model
+        entry["prompt_tokens"] = (
+            sum(context_builder.count(message) for message in conversation_history)
+            + context_builder.tokenizer(system_prompt)
+            + context_builder.tokenizer(trimmed_text)
+            + sum(context_builder.tokenizer(snippet) for snippet in recalled)
+        )
+        if recalled:
+            entry["recalled"] = len(recalled)
+
+        started = time.perf_counter()
+        tried = []
+        try:
+            while True:
+                tried.append(backend)
+                prompt_cache.apply(params, prompt.author.id, backend)
+                entry["backend"] = backend.name
+                entry["attempts"] = len(tried)
+                try:
+                    return await _stream_reply(backend, body, channel, started, entry)
+                except BackendFailed as e:
+                    API_ERRORS.inc(reason=e.reason)
+                    backend_pool.report_failure(backend, e.reason)
+                    backend_pool.release(backend)
+                    backend = backend_pool.pick(prompt.author.id, exclude=tried) if len(tried) < backend_pool.max_attempts else None
+                    if backend is None:
+                        entry["status"] = e.reason
+                        await channel.send(str(e))
+                        return ""
+                    BACKEND_RETRIES.inc()
+        except asyncio.CancelledError:
+            entry["status"] = "cancelled"
+            raise
+        finally:
+            entry.setdefault("status", "error")
+            entry["total"] = round(time.perf_counter() - started, 4)
+            request_log.write(entry)
+    finally:
+        if backend is not None:
+            backend_pool.release(backend)
+
+
+async def _stream_reply(backend, body, channel, started, entry):
+    """
+    Stream one completion from backend into channel and return the reply text.
+    Failures before the first token raise BackendFailed so the caller can try
+    another backend; later ones are reported in the channel as before.
+    Timings, counts and the outcome are filled into the request log entry.
+    """
+    body.params["model"] = backend.model
+    headers = {"Content-Type": "application/json"}
+    if backend.api_key:
+        headers["Authorization"] = f"Bearer {backend.api_key}"
+
+    session = get_http_session()
+    loop = asyncio.get_running_loop()
+    attempt_started = time.perf_counter()
+    first_token_timeout = GENERATION_CONFIG["first_token_timeout"]
+    idle_timeout = GENERATION_CONFIG["idle_timeout"]
+    first_token_deadline = loop.time() + first_token_timeout if first_token_timeout else None
+    first_token_at = None
+    token_count = 0
+    try:
+        resp = await _post_completion(session, backend, body, headers)
+        async with resp:
+            if resp.status != 200:
+                error_text = await resp.text()
+                message = f"❌ Lỗi từ OpenAI API: {resp.status} - {error_text}"
+                if resp.status >= 500:
+                    raise BackendFailed(str(resp.status), message)
+                API_ERRORS.inc(reason=str(resp.status))
+                entry["status"] = str(resp.status)
+                await channel.send(message)
+                return ""
+
+            parser = SSEParser()
+            assembler = StreamAssembler()
+            output = ReplyOutput(channel)
+            entry["ttft"] = None
+            done = False
+
+            async def handle(data):
+                nonlocal first_token_at, token_count
+                delta = _delta_text(data)
+                if delta:
+                    token_count += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        LLM_TTFT_SECONDS.observe(first_token_at - started)
+                        entry["ttft"] = round(first_token_at - started, 4)
+                        add_span("backend_ttft", attempt_started, first_token_at, backend=backend.name)
+                for piece in assembler.feed(delta):
+                    await output.push(piece)
+
+            try:
+                chunks = resp.content.iter_any()
+                while not done:
+                    # Only the wait for the backend is timed, not our own Discord sends
+                    if first_token_at is None:
+                        deadline = first_token_deadline
+                    else:
+                        deadline = loop.time() + idle_timeout if idle_timeout else None
+                    try:
+                        raw = await wait_until(chunks.__anext__(), deadline)
+                    except StopAsyncIteration:
+                        break
+                    for data in parser.feed(raw):
+                        if data == "[DONE]":
+                            done = True
+                            break
+                        await handle(data)
+
+                if not done:
+                    for data in parser.close():
+                        if data != "[DONE]":
+                            await handle(data)
+                for piece in assembler.finish():
+                    await output.push(piece)
+            except BaseException as e:
+                # Hang up instead of draining the stream, so the backend
+                # notices the disconnect and frees its slot right away
+                resp.close()
+                if isinstance(e, asyncio.CancelledError):
+                    output.discard()
+                raise
+            finally:
+                await output.close()
+                entry["tokens"] = token_count
+                entry["sends"] = output.send_count
+
+            finished = time.perf_counter()
+            LLM_GENERATION_SECONDS.observe(finished - started)
+            if first_token_at is not None and finished > first_token_at:
+                LLM_TOKENS_PER_SECOND.observe(token_count / (finished - first_token_at))
+            backend_pool.report_success(backend, first_token_at - attempt_started if first_token_at else None)
+            entry["status"] = "ok"
+            entry["reply_chars"] = len(assembler.text.strip())
+            return assembler.text.strip()
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+        message = f"❌ Lỗi kết nối đến OpenAI API: {e!r}"
+        if first_token_at is None:
+            raise BackendFailed(reason, message) from e
+        API_ERRORS.inc(reason=reason)
+        backend_pool.report_failure(backend, reason)
+        entry["status"] = reason
+        await channel.send(message)
+        return ""
+    finally:
+        if first_token_at is None:
+            add_span("backend_ttft", attempt_started, backend=backend.name, failed=True)
+        else:
+            add_span("backend_stream", first_token_at, tokens=token_count)
+
+
 # ----------------------------
-# Load configuration and env
+# Request scheduling
 # ----------------------------
-load_dotenv()
+class SchedulerBusy(Exception):
+    pass
 
-CONFIG_FILE = "config.json"
-STATUS_FILE = "games.json"
-MEMORY_FILE = "chat_memory.json"
 
+class RequestScheduler:
+    """
+    Admission control in front of the LLM backend.
 
-def load_config():
-    with open(CONFIG_FILE, "r", encoding="utf-8") as file:
-        data = json.load(file)
+    At most max_in_flight generations run at once, with separate caps per
+    user and per channel. Waiting requests are queued per user and granted
+    round-robin across users, so one chatty user can't starve the rest;
+    admins have their own queue that is always served first. When the queue
+    is full, or a request waits longer than max_wait seconds, it is shed
+    with SchedulerBusy instead of piling up.
+    """
 
-    data["model_name"] = os.getenv("MODEL_NAME", data.get("model_name", "gpt-4o"))
-    data["api_endpoint"] = os.getenv("API_ENDPOINT", data.get("api_endpoint", "https://api.openai.com/v1/chat/completions"))
-    data["system_prompt"] = os.getenv("SYSTEM_PROMPT", data.get("system_prompt", ""))
+    def __init__(self, max_in_flight=8, max_per_user=1, max_per_channel=4, max_queue=64, max_wait=120):
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.shed = 0
+        self._per_user = {}
+        self._per_channel = {}
+        self._priority = deque()
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._recent_waits = deque(maxlen=256)
 
-    trigger_env = os.getenv("TRIGGER_KEYWORDS")
-    if trigger_env:
-        data["trigger_keywords"] = [kw.strip().lower() for kw in trigger_env.split(",") if kw.strip()]
-    else:
-        data["trigger_keywords"] = [kw.lower() for kw in data.get("trigger_keywords", [])]
+    def stats(self) -> dict:
+        now = time.monotonic()
+        waiting = list(self._priority) + [w for queue in self._queues.values() for w in queue]
+        waits = list(self._recent_waits)
+        return {
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "queued_users": len(self._queues),
+            "oldest_wait": max((now - w["enqueued_at"] for w in waiting), default=0.0),
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_recent_wait": max(waits, default=0.0),
+            "shed": self.shed,
+        }
 
-    admin_env = os.getenv("ADMIN_IDS")
-    if admin_env:
-        data["admin_ids"] = [int(user_id.strip()) for user_id in admin_env.split(",") if user_id.strip().isdigit()]
-    else:
-        data["admin_ids"] = [int(user_id) for user_id in data.get("admin_ids", []) if str(user_id).isdigit()]
+    def _can_run(self, waiter) -> bool:
+        return (
+            self.in_flight < self.max_in_flight
+            and self._per_user.get(waiter["user_id"], 0) < self.max_per_user
+            and self._per_channel.get(waiter["channel_id"], 0) < self.max_per_channel
+        )
 
-    return data
+    def _start(self, waiter) -> None:
+        self._queued -= 1
+        self.in_flight += 1
+        self._per_user[waiter["user_id"]] = self._per_user.get(waiter["user_id"], 0) + 1
+        self._per_channel[waiter["channel_id"]] = self._per_channel.get(waiter["channel_id"], 0) + 1
+        waited = time.monotonic() - waiter["enqueued_at"]
+        self._recent_waits.append(waited)
+        QUEUE_WAIT_SECONDS.observe(waited)
+        waiter["future"].set_result(None)
 
+    def _dispatch(self) -> None:
+        for waiter in list(self._priority):
+            if self.in_flight >= self.max_in_flight:
+                return
+            if self._can_run(waiter):
+                self._priority.remove(waiter)
+                self._start(waiter)
 
-def load_file(filename, default_data):
-    try:
-        with open(filename, "r", encoding="utf-8") as file:
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        with open(filename, "w", encoding="utf-8") as file:
-            json.dump(default_data, file, indent=4, ensure_ascii=False)
-        return default_data
+        progressed = True
+        while progressed and self.in_flight < self.max_in_flight:
+            progressed = False
+            for user_id in list(self._queues):
+                queue = self._queues[user_id]
+                if not self._can_run(queue[0]):
+                    continue
+                self._start(queue.popleft())
+                # Served users go to the back of the line
+                del self._queues[user_id]
+                if queue:
+                    self._queues[user_id] = queue
+                progressed = True
+                if self.in_flight >= self.max_in_flight:
+                    return
 
+    def _remove(self, waiter) -> None:
+        if waiter in self._priority:
+            self._priority.remove(waiter)
+        else:
+            queue = self._queues.get(waiter["user_id"])
+            if queue is None or waiter not in queue:
+                return
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter["user_id"]]
+        self._queued -= 1
 
-def save_file(filename, data):
-    with open(filename, "w", encoding="utf-8") as file:
-        json.dump(data, file, indent=4, ensure_ascii=False)
+    def _release(self, user_id, channel_id) -> None:
+        self.in_flight -= 1
+        for counts, key in ((self._per_user, user_id), (self._per_channel, channel_id)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        self._dispatch()
 
-def trigger_matched(text: str, triggers: list[str]) -> bool:
-    text = text.lower()
-    for kw in triggers:
-        pattern = r"\b" + re.escape(kw.lower()) + r"\b"
-        if re.search(pattern, text):
-            return True
-    return False
+    async def acquire(self, user_id, channel_id, priority: bool = False) -> None:
+        if self._queued >= self.max_queue:
+            self.shed += 1
+            raise SchedulerBusy("queue full")
+
+        waiter = {
+            "future": asyncio.get_running_loop().create_future(),
+            "user_id": user_id,
+            "channel_id": channel_id,
+            "enqueued_at": time.monotonic(),
+        }
+        if priority:
+            self._priority.append(waiter)
+        else:
+            self._queues.setdefault(user_id, deque()).append(waiter)
+        self._queued += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter["future"], timeout=self.max_wait or None)
+        except asyncio.TimeoutError:
+            # The slot can be granted in the same loop iteration the wait runs out
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                return
+            self._remove(waiter)
+            self.shed += 1
+            raise SchedulerBusy("waited too long") from None
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                self._release(user_id, channel_id)
+            else:
+                self._remove(waiter)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, user_id, channel_id, priority: bool = False):
+        await self.acquire(user_id, channel_id, priority)
+        try:
+            yield
+        finally:
+            self._release(user_id, channel_id)
+
+
+request_scheduler = RequestScheduler(**SCHEDULER_CONFIG)
+
+# Read at scrape time from the objects that already keep these numbers
+metrics.gauge("llm_in_flight_requests", "Generations currently holding a scheduler slot", fn=lambda: request_scheduler.in_flight)
+metrics.gauge("llm_queued_requests", "Generations waiting for a scheduler slot", fn=lambda: request_scheduler._queued)
+metrics.gauge("llm_queued_users", "Users with at least one generation waiting", fn=lambda: request_scheduler.stats()["queued_users"])
+metrics.gauge("llm_queue_oldest_wait_seconds", "How long the longest-waiting generation has been queued", fn=lambda: request_scheduler.stats()["oldest_wait"])
+metrics.counter("llm_shed_requests_total", "Generations rejected by admission control", fn=lambda: request_scheduler.shed)
+metrics.gauge(
+    "llm_backend_healthy", "Whether a backend is currently receiving traffic (0 while ejected)",
+    fn=lambda: {(("backend", b["name"]),): int(b["healthy"]) for b in backend_pool.stats()},
+)
+metrics.gauge(
+    "llm_backend_in_flight_requests", "Generations currently streaming from a backend",
+    fn=lambda: {(("backend", b["name"]),): b["in_flight"] for b in backend_pool.stats()},
+)
+metrics.gauge(
+    "llm_backend_ttft_seconds", "Moving average of a backend's time to first token",
+    fn=lambda: {(("backend", b["name"]),): b["ttft"] for b in backend_pool.stats() if b["ttft"] is not None},
+)
+metrics.gauge("chat_memory_users", "Users with a conversation loaded in this process", fn=lambda: conversation_store.count())
+metrics.gauge("chat_memory_resident_bytes", "Estimated size of the loaded conversations", fn=lambda: conversation_store.resident_bytes())
+metrics.counter("image_cache_hits_total", "Image lookups served from memory or disk", fn=lambda: image_cache.hits)
+metrics.counter("image_cache_misses_total", "Image lookups that had to download", fn=lambda: image_cache.misses)
+metrics.gauge("image_cache_hit_ratio", "Share of image lookups served without downloading", fn=lambda: image_cache.stats()["hit_rate"])
+metrics.gauge("image_cache_resident_bytes", "Encoded images held in memory", fn=lambda: image_cache.stats()["resident_bytes"])
+metrics.gauge("image_cache_disk_bytes", "Encoded images held in the on-disk cache", fn=lambda: image_cache.stats()["disk_bytes"])
+metrics.counter("payload_cache_hits_total", "Requests that reused a serialized history prefix", fn=lambda: payload_cache.hits)
+metrics.counter("payload_cache_misses_total", "Requests that serialized their history from scratch", fn=lambda: payload_cache.misses)
 
-config = load_config()
-games = load_file(STATUS_FILE, [{"title": "Minecraft"}, {"title": "Half-Life 2"}])
-chat_memory = load_file(MEMORY_FILE, {})
 
 # ----------------------------
-# Bot setup
+# Generation tracking
 # ----------------------------
-intents = discord.Intents.default()
-intents.typing = False
-intents.presences = True
-intents.messages = True
-intents.message_content = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+class Generation:
+    __slots__ = ("task", "key", "message_ids", "reason")
 
-ADMIN_USER_IDS = config["admin_ids"]
-OPENAI_API_URL = config["api_endpoint"]
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-MODEL_NAME = config["model_name"]
-TRIGGER_KEYWORDS = config["trigger_keywords"]
-SYSTEM_PROMPT = ""
+    def __init__(self, task, key, message_ids):
+        self.task = task
+        self.key = key
+        self.message_ids = message_ids
+        self.reason = None
 
-if os.path.exists("system_prompt.txt"):
-    try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            SYSTEM_PROMPT = f.read()
-    except:
-        SYSTEM_PROMPT = ""
-else:
-    SYSTEM_PROMPT = config.get("system_prompt", "")
 
-# Simple in-memory cache for image data URLs to avoid re-encoding frequently
-IMAGE_CACHE = OrderedDict()
-MAX_IMAGE_CACHE_ITEMS = 32
-MAX_IMAGE_BYTES = 5 * 1024 * 1024  # 5 MB safety limit per image
+class GenerationRegistry:
+    """
+    In-flight generations, keyed by (user, channel) and by triggering message.
+
+    A newer triggering message from the same user in the same channel
+    supersedes the older generation, deleting the triggering message aborts
+    its generation, and /purgememory aborts the user's generations. Each
+    generation runs as its own task, so cancelling it unwinds the scheduler
+    slot, the typing indicator and the backend stream, which hangs up so the
+    server stops generating.
+    """
 
+    def __init__(self, supersede=True):
+        self.supersede = supersede
+        self._by_key = {}
+        self._by_message = {}
 
-def _is_image_attachment(attachment: discord.Attachment) -> bool:
-    if attachment.content_type:
-        return attachment.content_type.startswith("image/")
-    mime, _ = mimetypes.guess_type(attachment.filename)
-    return bool(mime and mime.startswith("image/"))
+    def start(self, message, coro, related_ids=()) -> Generation:
+        """related_ids are other triggering messages answered by the same generation."""
+        key = (message.author.id, message.channel.id)
+        previous = self._by_key.get(key)
+        if previous is not None and self.supersede:
+            self.cancel(previous, "superseded")
 
+        generation = Generation(asyncio.create_task(coro), key, (message.id, *related_ids))
+        self._by_key[key] = generation
+        for message_id in generation.message_ids:
+            self._by_message[message_id] = generation
+        generation.task.add_done_callback(lambda _: self._forget(generation))
+        return generation
 
-def _cache_image_data(url: str, data_url: str) -> None:
-    if url in IMAGE_CACHE:
-        IMAGE_CACHE.move_to_end(url)
-        IMAGE_CACHE[url] = data_url
-        return
+    def _forget(self, generation) -> None:
+        if self._by_key.get(generation.key) is generation:
+            del self._by_key[generation.key]
+        for message_id in generation.message_ids:
+            if self._by_message.get(message_id) is generation:
+                del self._by_message[message_id]
 
-    IMAGE_CACHE[url] = data_url
-    if len(IMAGE_CACHE) > MAX_IMAGE_CACHE_ITEMS:
-        IMAGE_CACHE.popitem(last=False)
+    def cancel(self, generation, reason: str) -> None:
+        if generation.task.done() or generation.reason is not None:
+            return
+        generation.reason = reason
+        generation.task.cancel()
+        GENERATIONS_CANCELLED.inc(reason=reason)
 
+    def cancel_message(self, message_id, reason: str = "deleted") -> None:
+        generation = self._by_message.get(message_id)
+        if generation is not None:
+            self.cancel(generation, reason)
 
-async def _attachment_to_data_url(attachment: discord.Attachment) -> str:
-    if attachment.url in IMAGE_CACHE:
-        return IMAGE_CACHE[attachment.url]
+    def cancel_user(self, user_id=None, reason: str = "purged") -> list:
+        """Cancel user_id's generations (everyone's with None); returns their tasks."""
+        tasks = []
+        for generation in list(self._by_key.values()):
+            if user_id is None or generation.key[0] == user_id:
+                self.cancel(generation, reason)
+                tasks.append(generation.task)
+        return tasks
 
-    if attachment.size and attachment.size > MAX_IMAGE_BYTES:
-        return ""
+    async def stop_user(self, user_id=None, reason: str = "purged", timeout: float = 2.0) -> None:
+        """
+        Cancel and wait for user_id's generations, so none of them stores a
+        reply after the caller deletes the user's memory. Only this process's
+        generations are seen; shard processes each stop their own.
+        """
+        tasks = self.cancel_user(user_id, reason)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
 
-    try:
-        image_bytes = await attachment.read()
-    except discord.HTTPException:
-        return ""
 
-    if len(image_bytes) > MAX_IMAGE_BYTES:
+generations = GenerationRegistry(supersede=GENERATION_CONFIG["supersede"])
+
+
+async def reply_with_llm(message, base_text, image_task=None, user_text_override=None, related_ids=()):
+    """
+    Generate a reply to message as a tracked, cancellable generation.
+    Returns "" when the generation was superseded or aborted.
+    """
+    generation = generations.start(
+        message,
+        _generate_reply(message, base_text, image_task, user_text_override),
+        related_ids,
+    )
+    try:
+        return await generation.task
+    except asyncio.CancelledError:
+        if generation.reason is None:
+            raise
+        print(f"⏹️ Dừng trả lời tin nhắn {message.id}: {generation.reason}")
         return ""
 
-    mime_type = attachment.content_type or mimetypes.guess_type(attachment.filename)[0] or "application/octet-stream"
-    encoded = base64.b64encode(image_bytes).decode("utf-8")
-    data_url = f"data:{mime_type};base64,{encoded}"
-    _cache_image_data(attachment.url, data_url)
-    return data_url
 
+async def _generate_reply(message, base_text, image_task=None, user_text_override=None):
+    """
+    Run one generation for message under admission control and record both turns.
+    image_task, if given, is the already running _collect_images() for the
+    message's attachments, so downloads overlap with waiting for a slot.
+    """
+    author = message.author
+    queued_at = time.perf_counter()
+    try:
+        async with request_scheduler.slot(author.id, message.channel.id, priority=author.id in ADMIN_USER_IDS):
+            add_span("queue", queued_at)
+            async with message.channel.typing():
+                images = []
+                if image_task is not None:
+                    with span("images"):
+                        images = await image_task
+                image_descriptions = [description for description, _ in images]
+                image_data_urls = [data_url for _, data_url in images]
 
-def _build_memory_message(base_text: str, image_descriptions: List[str]) -> str:
-    parts = []
-    if base_text and base_text.strip():
-        parts.append(base_text.strip())
-    for desc in image_descriptions:
-        parts.append(f"[🖼️ {desc}]")
-    if not parts:
-        return "[🖼️ Người dùng đã gửi hình ảnh]"
-    return "\n".join(parts)
+                memory_text = _build_memory_message(base_text, image_descriptions)
+                await update_memory(str(author.id), author.display_name, memory_text, "user")
+                response = await chat_response_stream(
+                    message,
+                    author.display_name,
+                    message.channel,
+                    image_data_urls=image_data_urls,
+                    user_text_override=user_text_override
+                )
+                await update_memory(str(author.id), author.display_name, response, "assistant")
+                if response:
+                    REPLIES.inc()
+                    prewarmer.note_reply(author.id, message.channel.id)
+                    if long_term_memory is not None:
+                        await long_term_memory.remember(str(author.id), f"{author.display_name}: {memory_text}", response)
+                return response
+    except SchedulerBusy:
+        request_log.write({**_request_entry(message), "status": "shed"})
+        await message.channel.send("⏳ Bot đang quá tải, bạn thử lại sau chút nhé!")
+        return ""
+    finally:
+        if image_task is not None and not image_task.done():
+            image_task.cancel()
 
 
 # ----------------------------
-# Memory management
+# Burst coalescing
 # ----------------------------
-def update_memory(user_id, username, message, role):
-    if user_id not in chat_memory:
-        chat_memory[user_id] = {
-            "username": username,
-            "messages": []
-        }
+class BurstPart:
+    __slots__ = ("message", "base_text", "user_text", "image_task")
 
-    if role == "user":
-        prefix = f"{username}:"
-        if message.strip().startswith(prefix):
-            new_content = message
-        else:
-            new_content = f"{username}: {message}"
-    else:
-        new_content = message
+    def __init__(self, message, base_text, user_text, image_task):
+        self.message = message
+        self.base_text = base_text
+        self.user_text = user_text
+        self.image_task = image_task
 
-    chat_memory[user_id]["messages"].append({"role": role, "content": new_content})
 
-    if len(chat_memory[user_id]["messages"]) > 6:
-        chat_memory[user_id]["messages"].pop(0)
+class Burst:
+    __slots__ = ("parts", "opened_at", "deadline")
 
-    save_file(MEMORY_FILE, chat_memory)
-# ---------------------------- 
-# Sanitizer (to be compatible with the new llama.cpp)      
-# ----------------------------                                                                       
-def sanitize_messages(messages):
+    def __init__(self, opened_at):
+        self.parts = []
+        self.opened_at = opened_at
+        self.deadline = opened_at
+
+
+async def _merge_image_tasks(tasks) -> List[tuple]:
+    results = await asyncio.gather(*tasks)
+    return [image for images in results for image in images]
+
+
+class BurstCoalescer:
     """
-    Hàm này đảm bảo:
-    1. Không bao giờ có 2 role giống nhau đứng cạnh nhau (merge content lại).
-    2. Message đầu tiên sau System PHẢI là User (nếu là Assistant thì xóa).
+    Folds a user's rapid-fire messages in one channel into a single reply.
+
+    The first triggering message opens a burst and waits; every message from
+    the same user in the same channel that arrives within `window` seconds
+    of the previous one (or of the user starting to type, with typing
+    events on) joins it, attachments included. Once the burst has been
+    quiet for `window` seconds, or `max_window` after it opened, its
+    messages go to the backend as one user turn: one generation, one
+    memory write per side. Deleting a message takes it back out.
     """
-    if not messages:
-        return []
 
-    sanitized = []
-    
-    # Tách system ra (nếu có)
-    has_system = messages[0]["role"] == "system"
-    start_index = 1 if has_system else 0
-    
-    if has_system:
-        sanitized.append(messages[0])
+    def __init__(self, window=0.0, max_window=6.0):
+        self.window = window
+        self.max_window = max_window
+        self._bursts = {}
 
-    # Xử lý phần còn lại
-    temp_messages = messages[start_index:]
-    
-    # Bỏ qua các tin nhắn Assistant ở đầu (nếu bị cắt mất User tương ứng)
-    while temp_messages and temp_messages[0]["role"] == "assistant":
-        temp_messages.pop(0)
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
 
-    for msg in temp_messages:
-        if not sanitized:
-            sanitized.append(msg)
-            continue
+    def _extend(self, burst, now) -> None:
+        burst.deadline = min(max(burst.deadline, now + self.window), burst.opened_at + self.max_window)
 
-        last_msg = sanitized[-1]
+    async def submit(self, message, base_text, image_task=None, user_text_override=None) -> str:
+        """Answer message, possibly together with the ones that follow it; returns the reply text."""
+        user_text = user_text_override if user_text_override is not None else message.content
+        part = BurstPart(message, base_text, user_text or "", image_task)
+        key = (message.author.id, message.channel.id)
+        loop = asyncio.get_running_loop()
+        burst = self._bursts.get(key)
+        if burst is not None:
+            burst.parts.append(part)
+            self._extend(burst, loop.time())
+            BURST_MESSAGES_MERGED.inc()
+            return ""
 
-        # Nếu role trùng nhau -> Merge content
-        # Nếu role trùng nhau -> Merge content
-        if last_msg["role"] == msg["role"]:
-            old_content = last_msg["content"]
-            new_content = msg["content"]
+        burst = self._bursts[key] = Burst(loop.time())
+        burst.parts.append(part)
+        self._extend(burst, burst.opened_at)
+        try:
+            with span("burst_wait"):
+                while (delay := burst.deadline - loop.time()) > 0:
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            for part in burst.parts:
+                if part.image_task is not None:
+                    part.image_task.cancel()
+            raise
+        finally:
+            if self._bursts.get(key) is burst:
+                del self._bursts[key]
+        if not burst.parts:
+            return ""
+        if len(burst.parts) == 1:
+            part = burst.parts[0]
+            return await reply_with_llm(part.message, part.base_text, part.image_task, part.user_text)
 
-            # --- FIX: NẾU CÓ CHỨA ẢNH (LIST), PHẢI MERGE CHUẨN JSON VISION ---
-            if isinstance(old_content, str) and isinstance(new_content, str):
-                # Nếu cả 2 đều là chữ thường, nối chuỗi bình thường
-                last_msg["content"] = f"{old_content}\n\n{new_content}"
-            else:
-                # Ép tất cả về dạng List chuẩn OpenAI
-                old_list = [{"type": "text", "text": old_content}] if isinstance(old_content, str) else old_content
-                new_list = [{"type": "text", "text": new_content}] if isinstance(new_content, str) else new_content
-        
-                # Cộng 2 mảng lại với nhau đéo làm mất cấu trúc Base64
-                last_msg["content"] = old_list + new_list
-        else:
-            sanitized.append(msg)
-            
-    return sanitized
+        last = burst.parts[-1].message
+        image_tasks = [part.image_task for part in burst.parts if part.image_task is not None]
+        return await reply_with_llm(
+            last,
+            "\n".join(part.base_text.strip() for part in burst.parts if part.base_text.strip()),
+            asyncio.create_task(_merge_image_tasks(image_tasks)) if image_tasks else None,
+            user_text_override="\n".join(part.user_text.strip() for part in burst.parts if part.user_text.strip()),
+            related_ids=[part.message.id for part in burst.parts[:-1]],
+        )
 
-# ----------------------------
-# OpenAI streaming response
-# ----------------------------
-async def chat_response_stream(prompt, author_name, channel, image_data_urls=None, user_text_override=None):
-    if not OPENAI_API_KEY:
-        await channel.send("❌ Error: OpenAI API key not set.")
-        return ""
+    def typing(self, user_id, channel_id) -> None:
+        burst = self._bursts.get((user_id, channel_id))
+        if burst is not None:
+            self._extend(burst, asyncio.get_running_loop().time())
 
-    system_prompt = SYSTEM_PROMPT
+    def discard(self, message_id) -> None:
+        for burst in self._bursts.values():
+            for part in burst.parts:
+                if part.message.id == message_id:
+                    burst.parts.remove(part)
+                    if part.image_task is not None:
+                        part.image_task.cancel()
+                    return
 
-    image_data_urls = image_data_urls or []
-    user_text = user_text_override if user_text_override is not None else prompt.content
-    user_text = user_text if user_text is not None else ""
 
-    conversation_history = chat_memory.get(str(prompt.author.id), {}).get("messages", [])
+bursts = BurstCoalescer(BURST_CONFIG["window"], BURST_CONFIG["max_window"])
 
-    messages = []
-    if system_prompt.strip():
-        messages.append({"role": "system", "content": system_prompt})
 
-    messages.extend({"role": msg["role"], "content": msg["content"]} for msg in conversation_history)
+async def dispatch_reply(message, base_text, image_task=None, user_text_override=None):
+    if bursts.enabled:
+        return await bursts.submit(message, base_text, image_task, user_text_override)
+    return await reply_with_llm(message, base_text, image_task, user_text_override)
 
-    user_payload = []
-    trimmed_text = user_text.strip()
-    if trimmed_text:
-        user_payload.append({"type": "text", "text": f"{author_name}: {trimmed_text}"})
-    elif image_data_urls:
-        user_payload.append({"type": "text", "text": f"{author_name} đã gửi {len(image_data_urls)} hình ảnh."})
 
-    if image_data_urls:
-        for data_url in image_data_urls:
-            if data_url:
-                user_payload.append({"type": "image_url", "image_url": {"url": data_url}})
+# ----------------------------
+# Typing prewarm
+# ----------------------------
+class Prewarmer:
+    """
+    Prefills a user's prompt prefix on the backend while they are typing.
 
-    if not user_payload:
-        user_payload.append({"type": "text", "text": f"{author_name} sent an empty message."})
+    When someone the bot answered in the same channel within recent_seconds
+    starts typing, their system prompt and history window, exactly as their
+    next request will start, go to the backend as a prompt-only request
+    (max_tokens 0, with the prompt-cache slot their request will use). By
+    the time the message arrives the server only has to process the new
+    turn. Each user is prewarmed at most every min_interval seconds, never
+    while the scheduler is saturated, and only on backends that accept such
+    requests: one that rejects a prewarm is not prewarmed again.
+    """
 
-    messages.append({"role": "user", "content": user_payload})
-    final_messages = sanitize_messages(messages)
+    def __init__(self, enabled=False, recent_seconds=600, min_interval=30, max_concurrent=2, timeout=15,
+                 max_users=4096):
+        self.enabled = enabled
+        self.recent_seconds = recent_seconds
+        self.min_interval = min_interval
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.max_users = max_users
+        self._replied = OrderedDict()  # (user_id, channel_id) -> when the bot last answered there
+        self._warmed = OrderedDict()  # user_id -> when they were last prewarmed
+        self._tasks = set()
 
-    payload = {
-        "model": MODEL_NAME,
-        "messages": final_messages,
-        "max_tokens": 4096,
-        "stream": True,
-        "user": str(prompt.author.id),
-        "user_display_name": f"{prompt.author.display_name} ({prompt.author.name})"
-    }
+    def note_reply(self, user_id, channel_id) -> None:
+        if not self.enabled:
+            return
+        key = (user_id, channel_id)
+        self._replied[key] = time.monotonic()
+        self._replied.move_to_end(key)
+        if len(self._replied) > self.max_users:
+            self._replied.popitem(last=False)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
+    def typing(self, user_id, channel_id) -> None:
+        if not self.enabled or not prompt_cache.enabled:
+            return
+        now = time.monotonic()
+        replied = self._replied.get((user_id, channel_id))
+        if replied is None or now - replied > self.recent_seconds:
+            return
+        warmed = self._warmed.get(user_id)
+        if warmed is not None and now - warmed < self.min_interval:
+            return
+        if len(self._tasks) >= self.max_concurrent or request_scheduler.in_flight >= request_scheduler.max_in_flight:
+            return
+        self._warmed[user_id] = now
+        self._warmed.move_to_end(user_id)
+        if len(self._warmed) > self.max_users:
+            self._warmed.popitem(last=False)
+        task = asyncio.create_task(self._warm(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-    async with aiohttp.ClientSession(headers=headers) as session:
+    async def _warm(self, user_id) -> None:
+        record = await conversation_store.get(str(user_id))
+        if not record or not record.get("messages"):
+            return
+        backend = backend_pool.pick(user_id)
         try:
-            async with session.post(OPENAI_API_URL, json=payload, timeout=300) as resp:
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    await channel.send(f"❌ Lỗi từ OpenAI API: {resp.status} - {error_text}")
-                    return ""
-
-                full_response = ""
-                processed_idx = 0
-                send_idx = 0
-                codeblock_stack = []
-
-                async def drain_lines_up_to(limit):
-                    nonlocal send_idx, full_response
-                    while True:
-                        idx = full_response.find("\n", send_idx, limit)
-                        if idx == -1:
-                            break
-                        piece = full_response[send_idx: idx + 1]
-                        if piece.strip() != "":
-                            await channel.send(piece.rstrip("\n"))
-                        send_idx = idx + 1
-
-                async for raw in resp.content:
-                    chunk = raw.decode("utf-8")
-                    for line in chunk.splitlines():
-                        line = line.strip()
-                        if not line or not line.startswith("data:"):
-                            continue
-                        json_str = line[len("data:"):].strip()
-                        if json_str == "[DONE]":
-                            break
-                        try:
-                            j = json.loads(json_str)
-                        except Exception as e:
-                            print("json load error", e, json_str)
-                            continue
-
-                        delta_obj = j.get("choices", [{}])[0].get("delta", {})
-                        if not delta_obj:
-                            continue
-
-                        delta = delta_obj.get("content")
-                        if isinstance(delta, list):
-                            delta = "".join(part.get("text", "") for part in delta if part.get("type") == "text")
-                        elif not isinstance(delta, str):
-                            delta = ""
-
-                        if not delta:
-                            continue
-
-                        prev_len = len(full_response)
-                        full_response += delta
-                        new_len = len(full_response)
-                        search_start = max(0, processed_idx - 2)
-                        new_section = full_response[search_start:]
-                        offset = search_start
-                        find_pos = new_section.find("```")
-                        while find_pos != -1:
-                            abs_pos = offset + find_pos
-                            if abs_pos >= processed_idx:
-                                if not codeblock_stack:
-                                    codeblock_stack.append(abs_pos)
-                                else:
-                                    start_pos = codeblock_stack.pop()
-                                    end_pos = abs_pos + 3
-                                    if send_idx < start_pos:
-                                        await drain_lines_up_to(start_pos)
-                                    block = full_response[start_pos:end_pos]
-                                    if block.strip() != "":
-                                        await channel.send(block)
-                                    send_idx = end_pos
-                            find_pos = new_section.find("```", find_pos + 3)
-
-                        processed_idx = new_len
-                        if not codeblock_stack:
-                            await drain_lines_up_to(len(full_response))
-
-                if codeblock_stack:
-                    if full_response[send_idx:].strip() != "":
-                        await channel.send(full_response[send_idx:].strip())
-                    send_idx = len(full_response)
-                else:
-                    if send_idx < len(full_response):
-                        tail = full_response[send_idx:].strip()
-                        if tail:
-                            await channel.send(tail)
-
-                return full_response.strip()
-
-        except aiohttp.ClientError as e:
-            await channel.send(f"❌ Lỗi kết nối đến OpenAI API: {e}")
-            return ""
+            if not backend.prewarm or not backend.prompt_cache or (backend.requires_key and not backend.api_key) or backend.ejected_until > time.monotonic():
+                return
+            system_prompt, history = _request_prefix(str(user_id), record, backend.model)
+            params = {"model": backend.model, "max_tokens": 0, "stream": False, "user": str(user_id)}
+            prompt_cache.apply(params, user_id, backend)
+            body = RequestBody(payload_cache.messages(str(user_id), system_prompt, history), params)
+            headers = {"Content-Type": "application/json"}
+            if backend.api_key:
+                headers["Authorization"] = f"Bearer {backend.api_key}"
+            async def send():
+                async with await body.post(get_http_session(), backend.url, headers) as resp:
+                    await resp.read()
+                return resp
+
+            try:
+                resp = await wait_until(send(), asyncio.get_running_loop().time() + self.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                PREWARMS.inc(status="error")
+                return
+            PREWARMS.inc(status=str(resp.status))
+            if 400 <= resp.status < 500:
+                backend.prewarm = False
+                print(f"⚠️ Backend {backend.name} không nhận request prewarm ({resp.status}), tắt prewarm cho backend này")
+        finally:
+            backend_pool.release(backend)
+
+
+prewarmer = Prewarmer(
+    enabled=PREWARM_CONFIG["enabled"],
+    recent_seconds=PREWARM_CONFIG["recent_seconds"],
+    min_interval=PREWARM_CONFIG["min_interval"],
+    max_concurrent=PREWARM_CONFIG["max_concurrent"],
+    timeout=PREWARM_CONFIG["timeout"],
+)
 
 
 # ----------------------------
@@ -402,6 +4030,15 @@ async def typing_indicator(channel):
 # ----------------------------
 # Slash commands
 # ----------------------------
+async def _delete_memory(user_id: str) -> bool:
+    deleted = await conversation_store.delete(user_id)
+    if long_term_memory is not None:
+        deleted = await long_term_memory.forget(user_id) or deleted
+    context_builder.forget(user_id)
+    payload_cache.forget(user_id)
+    return deleted
+
+
 @bot.tree.command(name="purgememory", description="Xóa bộ nhớ trò chuyện với bot")
 @app_commands.describe(
     scope="Chọn phạm vi cần xóa",
@@ -417,16 +4054,14 @@ async def purgememory(
     scope: app_commands.Choice[str],
     target: discord.User = None
 ):
-    global chat_memory
-
     if scope.value == "me":
         user_id = str(interaction.user.id)
-        if user_id in chat_memory:
-            del chat_memory[user_id]
-            save_file(MEMORY_FILE, chat_memory)
-            await interaction.response.send_message("🧹 Đã xóa bộ nhớ của bạn với bot.", ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        await generations.stop_user(int(user_id))
+        if await _delete_memory(user_id):
+            await interaction.followup.send("🧹 Đã xóa bộ nhớ của bạn với bot.", ephemeral=True)
         else:
-            await interaction.response.send_message("ℹ️ Bạn không có dữ liệu bộ nhớ nào để xóa.", ephemeral=True)
+            await interaction.followup.send("ℹ️ Bạn không có dữ liệu bộ nhớ nào để xóa.", ephemeral=True)
 
     elif scope.value == "user":
         if interaction.user.id not in ADMIN_USER_IDS:
@@ -437,21 +4072,77 @@ async def purgememory(
             return
 
         user_id = str(target.id)
-        if user_id in chat_memory:
-            del chat_memory[user_id]
-            save_file(MEMORY_FILE, chat_memory)
-            await interaction.response.send_message(f"🧹 Đã xóa bộ nhớ của {target.mention}.", ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        await generations.stop_user(int(user_id))
+        if await _delete_memory(user_id):
+            await interaction.followup.send(f"🧹 Đã xóa bộ nhớ của {target.mention}.", ephemeral=True)
         else:
-            await interaction.response.send_message(f"ℹ️ {target.mention} không có dữ liệu bộ nhớ nào.", ephemeral=True)
+            await interaction.followup.send(f"ℹ️ {target.mention} không có dữ liệu bộ nhớ nào.", ephemeral=True)
 
     elif scope.value == "all":
         if interaction.user.id not in ADMIN_USER_IDS:
             await interaction.response.send_message("❌ Bạn không có quyền dùng tùy chọn này!", ephemeral=True)
             return
 
-        chat_memory = {}
-        save_file(MEMORY_FILE, chat_memory)
-        await interaction.response.send_message("🧹 Đã xóa toàn bộ bộ nhớ của bot.", ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        await generations.stop_user()
+        await conversation_store.clear()
+        context_builder.forget()
+        payload_cache.forget()
+        if long_term_memory is not None:
+            await long_term_memory.forget()
+        await interaction.followup.send("🧹 Đã xóa toàn bộ bộ nhớ của bot.", ephemeral=True)
+
+
+def _format_slow_traces(traces, limit: int) -> List[str]:
+    lines = []
+    for trace in list(traces)[-limit:][::-1]:
+        stages = sorted(trace.breakdown().items(), key=lambda item: item[1], reverse=True)[:6]
+        when = time.strftime("%H:%M:%S", time.localtime(trace.wall_start))
+        attrs = " ".join(f"{key}={value}" for key, value in trace.attrs.items())
+        lines.append(f"{when} {trace.duration:6.2f}s {attrs}")
+        lines.append("    " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in stages))
+    return lines
+
+
+@bot.tree.command(name="slowtraces", description="Xem các request chậm gần đây (admin only)")
+@app_commands.describe(
+    count="Số request muốn xem",
+    export="Gửi kèm file trace định dạng Chrome (chrome://tracing, Perfetto)"
+)
+async def slowtraces(interaction: discord.Interaction, count: int = 5, export: bool = False):
+    if interaction.user.id not in ADMIN_USER_IDS:
+        await interaction.response.send_message("❌ Bạn không có quyền dùng lệnh này!", ephemeral=True)
+        return
+
+    loop = asyncio.get_running_loop()
+    before = loop.time()
+    await asyncio.sleep(0)
+    lag = loop.time() - before
+
+    header = [f"⏱️ Event loop lag: {lag * 1000:.1f}ms"]
+    sampled = EVENT_LOOP_LAG_SECONDS.values.get(())
+    if sampled is not None:
+        header[0] += f" (sampled: {sampled * 1000:.1f}ms)"
+    if not tracer.enabled:
+        header.append("ℹ️ Tracing đang tắt (tracing.enabled).")
+    header.append(f"Request chậm hơn {tracer.slow_seconds}s: {len(tracer.slow)} / {tracer.finished} request đã trace")
+
+    body = _format_slow_traces(tracer.slow, max(1, count))
+    text = "\n".join(header)
+    if body:
+        text += "\n```\n"
+        for line in body:
+            if len(text) + len(line) + 5 > 1990:
+                break
+            text += line + "\n"
+        text += "```"
+
+    files = []
+    if export and tracer.slow:
+        data = json.dumps(Tracer.chrome_trace(list(tracer.slow)), ensure_ascii=False).encode("utf-8")
+        files.append(discord.File(io.BytesIO(data), filename="slow_traces.json"))
+    await interaction.response.send_message(text, files=files, ephemeral=True)
 
 
 # ----------------------------
@@ -460,11 +4151,13 @@ async def purgememory(
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user}")
-    try:
-        synced = await bot.tree.sync()
-        print(f"✅ Slash commands synced: {len(synced)}")
-    except Exception as e:
-        print(f"❌ Lỗi sync lệnh: {e}")
+    # Commands are global, so one shard process syncing them is enough
+    if not SHARD_IDS or 0 in SHARD_IDS:
+        try:
+            synced = await bot.tree.sync()
+            print(f"✅ Slash commands synced: {len(synced)}")
+        except Exception as e:
+            print(f"❌ Lỗi sync lệnh: {e}")
     change_game_status.start()
 
 
@@ -475,79 +4168,76 @@ async def on_message(message):
     if message.mention_everyone or message.role_mentions:
         return
 
-    image_data_urls = []
-    image_descriptions = []
+    recent_messages.remember(message)
 
-    if message.attachments:
-        for attachment in message.attachments:
-            if _is_image_attachment(attachment):
-                data_url = await _attachment_to_data_url(attachment)
-                if data_url:
-                    image_data_urls.append(data_url)
-                    image_descriptions.append(attachment.filename or "Hình ảnh")
-
-    if bot.user.mentioned_in(message) and not message.reference:
-        async with message.channel.typing():
-            update_memory(
-                str(message.author.id),
-                message.author.display_name,
-                _build_memory_message(message.content, image_descriptions),
-                "user"
-            )
-            response = await chat_response_stream(message, message.author.display_name, message.channel, image_data_urls=image_data_urls)
-            update_memory(str(message.author.id), message.author.display_name, response, "assistant")
-        return
+    # Decide whether to answer before touching attachments or the replied-to message
+    if bot.user.mentioned_in(message):
+        MENTIONS.inc()
+    else:
+        keyword = match_trigger(message.content, TRIGGER_KEYWORDS)
+        if keyword is None:
+            await bot.process_commands(message)
+            return
+        TRIGGER_MATCHES.inc(keyword=keyword)
 
-    if message.reference:
-        replied_message = await message.channel.fetch_message(message.reference.message_id)
-        original_author = replied_message.author
-        original_content = replied_message.content
-        user_content = message.content.replace(f"<@{bot.user.id}>", "").strip()
+    trace = tracer.begin("on_message", message=message.id, user=message.author.id, channel=message.channel.id)
+    try:
+        await _answer_message(message)
+    finally:
+        tracer.end(trace)
 
-        if bot.user.mentioned_in(message) or trigger_matched(message.content, TRIGGER_KEYWORDS):
-            async with message.channel.typing():
-                if original_author.id == bot.user.id:
-                    update_memory(
-                        str(message.author.id),
-                        message.author.display_name,
-                        _build_memory_message(user_content, image_descriptions),
-                        "user"
-                    )
-                else:
-                    combined_prompt = (
-                        f"Original message from {original_author.display_name}: {original_content}\n"
-                        f"Reply from {message.author.display_name}: {user_content}"
-                    )
-                    update_memory(
-                        str(message.author.id),
-                        message.author.display_name,
-                        _build_memory_message(combined_prompt, image_descriptions),
-                        "user"
-                    )
 
-                response = await chat_response_stream(
-                    message,
-                    message.author.display_name,
-                    message.channel,
-                    image_data_urls=image_data_urls,
-                    user_text_override=user_content if original_author.id == bot.user.id else combined_prompt
-                )
-                update_memory(str(message.author.id), message.author.display_name, response, "assistant")
-            return
+async def _answer_message(message):
+    image_task = None
+    if any(_is_image_attachment(attachment) for attachment in message.attachments):
+        image_task = asyncio.create_task(_collect_images(message.attachments))
 
-    elif trigger_matched(message.content, TRIGGER_KEYWORDS):
-        async with message.channel.typing():
-            update_memory(
-                str(message.author.id),
-                message.author.display_name,
-                _build_memory_message(message.content, image_descriptions),
-                "user"
-            )
-            response = await chat_response_stream(message, message.author.display_name, message.channel, image_data_urls=image_data_urls)
-            update_memory(str(message.author.id), message.author.display_name, response, "assistant")
+    replied_message = None
+    if message.reference and message.reference.message_id:
+        try:
+            with span("fetch_message"):
+                replied_message = await resolve_reference(message)
+        except discord.HTTPException:
+            if image_task is not None:
+                image_task.cancel()
+            raise
+
+    if replied_message is None:
+        await dispatch_reply(message, message.content, image_task)
         return
 
-    await bot.process_commands(message)
+    user_content = message.content.replace(f"<@{bot.user.id}>", "").strip()
+
+    if replied_message.author_id == bot.user.id:
+        await dispatch_reply(message, user_content, image_task, user_text_override=user_content)
+    else:
+        combined_prompt = (
+            f"Original message from {replied_message.author_name}: {replied_message.content}\n"
+            f"Reply from {message.author.display_name}: {user_content}"
+        )
+        await dispatch_reply(message, combined_prompt, image_task, user_text_override=combined_prompt)
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    if GENERATION_CONFIG["cancel_on_delete"]:
+        bursts.discard(payload.message_id)
+        generations.cancel_message(payload.message_id)
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if GENERATION_CONFIG["cancel_on_delete"]:
+        for message_id in payload.message_ids:
+            bursts.discard(message_id)
+            generations.cancel_message(message_id)
+
+
+@bot.event
+async def on_typing(channel, user, when):
+    if BURST_CONFIG["follow_typing"]:
+        bursts.typing(user.id, channel.id)
+    prewarmer.typing(user.id, channel.id)
 
 
 # ----------------------------
@@ -570,11 +4260,10 @@ async def before_status():
 # ----------------------------
 @bot.command()
 async def system(ctx, *, input: str):
-    async with ctx.typing():
-        update_memory(str(ctx.author.id), ctx.author.display_name, input, "user")
-        response = await chat_response_stream(ctx.message, ctx.author.display_name, ctx.channel, user_text_override=input)
-        update_memory(str(ctx.author.id), ctx.author.display_name, response, "assistant")
-        await ctx.send(response)
+    response = await reply_with_llm(ctx.message, input, user_text_override=input)
+    if response:
+        for part in split_message(response, OUTPUT_CONFIG["max_message_chars"]):
+            await ctx.send(part)
 
 
 # ----------------------------
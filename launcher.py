@@ -0,0 +1,95 @@
+"""
+Run the bot as several shard processes sharing one conversation store.
+
+Each process gets SHARD_COUNT and its SHARD_IDS through the environment and
+runs bot.py as an AutoShardedBot for those shards. Conversations must live
+in the SQLite store ("store": {"backend": "sqlite"} in config.json) so every
+process sees the same memory and /purgememory deletes it everywhere. Only
+the process handling the command stops the user's in-flight replies first;
+a reply still being written by another process can store its turn after
+the purge. A process that exits is restarted after a short backoff; Ctrl+C
+stops them all.
+
+    python launcher.py --processes 4 --shards 8
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+
+def shard_groups(shards: int, processes: int) -> list:
+    """Spread shard ids 0..shards-1 over the processes round-robin."""
+    return [list(range(i, shards, processes)) for i in range(processes)]
+
+
+def check_store(config_file: str) -> None:
+    with open(config_file, "r", encoding="utf-8") as file:
+        backend = json.load(file).get("store", {}).get("backend", "sqlite")
+    if backend != "sqlite":
+        raise SystemExit(
+            f'Sharded mode needs a shared store; set "store": {{"backend": "sqlite"}} in {config_file} '
+            f"(currently {backend!r})."
+        )
+
+
+def spawn(shard_ids: list, shard_count: int) -> subprocess.Popen:
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=",".join(map(str, shard_ids)))
+    print(f"🚀 Starting shards {shard_ids} of {shard_count}")
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--shards", type=int, default=0, help="total shard count (defaults to --processes)")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--restart-delay", type=float, default=5.0, help="seconds before restarting a process")
+    args = parser.parse_args()
+
+    shard_count = args.shards or args.processes
+    if args.processes < 1 or shard_count < args.processes:
+        parser.error("need at least one process and no more processes than shards")
+    check_store(args.config)
+
+    groups = shard_groups(shard_count, args.processes)
+    procs = [spawn(group, shard_count) for group in groups]
+    restart_at = [None] * len(procs)
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        time.sleep(0.5)
+        now = time.monotonic()
+        for i, proc in enumerate(procs):
+            if restart_at[i] is not None:
+                if now >= restart_at[i]:
+                    procs[i] = spawn(groups[i], shard_count)
+                    restart_at[i] = None
+            elif proc.poll() is not None:
+                print(f"⚠️ Shards {groups[i]} exited with code {proc.returncode}, restarting in {args.restart_delay}s")
+                restart_at[i] = now + args.restart_delay
+
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+if __name__ == "__main__":
+    main()